@@ -0,0 +1,74 @@
+import shutil
+import threading
+from pathlib import Path
+from typing import Optional
+
+import chromadb
+
+BASE_DIR = Path(__file__).parent.parent  # поднимаемся из ai_service в backend
+CHROMA_PATH = BASE_DIR / "chroma_db"
+CHATS_DIR = BASE_DIR / "chats"  # промежуточные файлы пайплайна, по папке на чат
+DEFAULT_COLLECTION = "research_papers"  # коллекция для запуска без чата (из консоли)
+PIPELINE_INCOMPLETE_MARKER = "pipeline_incomplete"  # есть, пока анализ и векторизация чата не прошли до конца
+
+_chroma_client = None
+_chroma_client_lock = threading.Lock()
+
+
+def get_chroma_client() -> chromadb.ClientAPI:
+    """Один PersistentClient на процесс, общий для индексации и поиска."""
+    global _chroma_client
+    with _chroma_client_lock:
+        if _chroma_client is None:
+            _chroma_client = chromadb.PersistentClient(path=str(CHROMA_PATH))
+        return _chroma_client
+
+
+def collection_name(chat_id: Optional[int] = None) -> str:
+    """Имя векторной коллекции чата."""
+    return DEFAULT_COLLECTION if chat_id is None else f"chat_{chat_id}"
+
+
+def chat_dir(chat_id: Optional[int] = None) -> Path:
+    """Папка промежуточных файлов чата (создается при первом обращении)."""
+    path = BASE_DIR if chat_id is None else CHATS_DIR / f"chat_{chat_id}"
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def artifact_path(chat_id: Optional[int], filename: str) -> Path:
+    """
+    Путь к файлу пайплайна чата: relevant_texts.json, irrelevant_files.json, unscored_files.json,
+    vector_db_info.json, literature_review.txt, маркер PIPELINE_INCOMPLETE_MARKER.
+    """
+    return chat_dir(chat_id) / filename
+
+
+def mark_pipeline_incomplete(chat_id: Optional[int]) -> None:
+    """Отмечает, что анализ и векторизация чата начаты и еще не завершились успешно."""
+    artifact_path(chat_id, PIPELINE_INCOMPLETE_MARKER).touch()
+
+
+def clear_pipeline_incomplete(chat_id: Optional[int]) -> None:
+    """Снимает отметку после успешной векторизации."""
+    artifact_path(chat_id, PIPELINE_INCOMPLETE_MARKER).unlink(missing_ok=True)
+
+
+def is_pipeline_incomplete(chat_id: Optional[int]) -> bool:
+    """
+    Нужно ли повторить анализ и векторизацию: прошлый запуск упал или не уложился
+    в таймаут, либо индекс чата еще не строился (нет vector_db_info.json).
+    """
+    return (artifact_path(chat_id, PIPELINE_INCOMPLETE_MARKER).exists()
+            or not artifact_path(chat_id, "vector_db_info.json").exists())
+
+
+def delete_chat_data(chat_id: int) -> None:
+    """Удаляет векторную коллекцию, промежуточные файлы чата и его индекс из памяти."""
+    from ai_service.vector_store import forget_loaded_store  # vector_store импортирует этот модуль
+    forget_loaded_store(chat_id)
+    try:
+        get_chroma_client().delete_collection(collection_name(chat_id))
+    except Exception:
+        pass  # коллекции могло и не быть
+    shutil.rmtree(CHATS_DIR / f"chat_{chat_id}", ignore_errors=True)
@@ -1,31 +1,130 @@
 import os
-import PyPDF2
+import atexit
+import multiprocessing
+import threading
 import openai
-from typing import Dict, List, Tuple
-from openai import OpenAI
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from openai import AsyncOpenAI
 import json
+import asyncio
+import re
+import time
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 
-import config as cn
+from ai_service.pdf_cache import PdfTextCache, file_sha256
+from ai_service.pdf_extract import extract_pages_from_pdf, extract_sample_pages, pages_to_text
+from ai_service.llm_cache import response_cache
+from ai_service.llm_client import chat_completion, chat_completion_async, create_async_client
+from ai_service.llm_client import get_stats as get_llm_stats
+from ai_service.document_store import STATUS_NO_TEXT, STATUS_OK, SUMMARY_FULL, SUMMARY_SAMPLE, document_store
+from ai_service.chat_workspace import artifact_path
+from ai_service.embeddings import get_model
 
 BASE_DIR = Path(__file__).parent.parent  # поднимаемся из ai_service в backend
 PDF_FOLDER = BASE_DIR / "uploads"
+PDF_WORKERS = os.cpu_count() or 1  # процессов в общем пуле извлечения текста (на все чаты)
+PDF_TRIAGE = True  # сначала оценивать по выборке страниц, полный текст - только для релевантных
+RELEVANCE_THRESHOLD = 6  # минимальная оценка релевантного источника
+PDF_TEXT_CACHE_DIR = BASE_DIR / "cache" / "pdf_text"
+PDF_TEXT_CACHE_MAX_BYTES = 500 * 1024 * 1024  # 500 МБ извлеченного текста
+
+pdf_text_cache = PdfTextCache(PDF_TEXT_CACHE_DIR, PDF_TEXT_CACHE_MAX_BYTES)
+
+LLM_CONCURRENCY = 8  # одновременных запросов к LLM при анализе файлов
+LLM_TIMEOUT = 30  # секунд на один запрос summary/оценки
+ANALYSIS_LLM_BUDGET = 90  # секунд на все запросы анализа с повторами (шаг анализа ограничен 120 с)
+RELEVANCE_BATCH_SIZE = 10  # summary в одном запросе пакетной оценки
+EMBEDDING_PREFILTER = True  # отклонять явно нерелевантные файлы по сходству эмбеддингов без LLM
+EMBEDDING_REJECT_SIMILARITY = 0.15  # сходство темы и summary, ниже которого файл нерелевантен
 
-client = OpenAI(api_key=cn.DEEPSEEK_API_KEY, base_url="https://openrouter.ai/api/v1")
 
 def extract_text_from_pdf(pdf_path: str) -> str:
     """Извлекает весь текст из PDF файла."""
-    text = ""
-    try:
-        with open(pdf_path, 'rb') as file:
-            reader = PyPDF2.PdfReader(file)
-            for page in reader.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    text += page_text + "\n"
-    except Exception as e:
-        print(f"Ошибка чтения {pdf_path}: {e}")
-    return text
+    pages, _ = extract_pages_from_pdf(pdf_path)
+    return pages_to_text(pages)
+
+_pdf_pool: Optional[ProcessPoolExecutor] = None
+_pdf_pool_lock = threading.Lock()
+
+def get_pdf_pool() -> ProcessPoolExecutor:
+    """
+    Общий для всех чатов пул процессов извлечения текста, создается при первом обращении.
+    Процессы запускаются через forkserver (на Windows - spawn), а не fork из
+    многопоточного сервера. В пул отправляются только функции из ai_service.pdf_extract,
+    который импортирует один PyPDF2, поэтому процессы не загружают torch, chromadb
+    и остальные модули сервиса.
+    """
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            mp_context = multiprocessing.get_context(method)
+            if method == "forkserver":
+                # forkserver импортирует PyPDF2 один раз, процессы пула наследуют его
+                mp_context.set_forkserver_preload(["ai_service.pdf_extract"])
+            _pdf_pool = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=mp_context)
+            atexit.register(_pdf_pool.shutdown, wait=False, cancel_futures=True)
+        return _pdf_pool
+
+def reset_pdf_pool(pool: ProcessPoolExecutor) -> None:
+    """Отбрасывает сломанный пул (упал процесс), следующий вызов get_pdf_pool создаст новый."""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is pool:
+            _pdf_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def extract_texts_parallel(pdf_paths: Dict[int, str], max_workers: int = PDF_WORKERS,
+                           extractor: Callable[[str], Tuple[List[str], bool]] = extract_pages_from_pdf
+                           ) -> Tuple[Dict[int, List[str]], Set[int]]:
+    """
+    Извлекает текст из нескольких PDF параллельно в общем пуле процессов (get_pdf_pool).
+    - pdf_paths: словарь {номер_файла: путь_к_pdf}
+    - max_workers: при 1 (или одном файле) извлечение идет в текущем потоке без пула
+    - extractor: функция извлечения (все страницы или только выборка для триажа)
+    Возвращает словарь {номер_файла: список_текстов_страниц} и множество номеров файлов,
+    извлеченных не полностью (ошибка чтения посреди документа или падение процесса).
+    Ошибка в одном файле не прерывает обработку остальных.
+    """
+    texts = {}
+    incomplete = set()
+    workers = max(1, min(max_workers, len(pdf_paths)))
+
+    # Для одного файла пул процессов не нужен
+    if workers == 1:
+        for idx, pdf_path in pdf_paths.items():
+            texts[idx], complete = extractor(pdf_path)
+            if not complete:
+                incomplete.add(idx)
+        return texts, incomplete
+
+    executor = get_pdf_pool()
+    futures = {
+        executor.submit(extractor, pdf_path): idx
+        for idx, pdf_path in pdf_paths.items()
+    }
+    # Забираем результаты по мере готовности
+    for future in as_completed(futures):
+        idx = futures[future]
+        try:
+            texts[idx], complete = future.result()
+            if not complete:
+                incomplete.add(idx)
+        except BrokenProcessPool as e:
+            print(f"Ошибка извлечения текста из файла #{idx}: пул процессов сломан ({e})")
+            reset_pdf_pool(executor)
+            texts[idx] = []
+            incomplete.add(idx)
+        except Exception as e:
+            print(f"Ошибка извлечения текста из файла #{idx}: {e}")
+            texts[idx] = []
+            incomplete.add(idx)
+        print(f"  Текст файла #{idx} извлечен ({len(texts[idx])} страниц"
+              f"{', не полностью' if idx in incomplete else ''})")
+
+    return texts, incomplete
 
 def get_smart_text_sample(text: str, sample_size: int = 1500) -> str:
     """
@@ -53,51 +152,292 @@ def get_smart_text_sample(text: str, sample_size: int = 1500) -> str:
     
     return f"{part1}\n[...]\n{part2}\n[...]\n{part3}"
 
-def get_article_summary(text: str) -> str:
-    """Получает свертку (основную тему) статьи из первых 1000 символов."""
+def build_summary_prompt(text: str) -> str:
     first_chunk = get_smart_text_sample(text)
-    prompt = f"В одном предложении сформулируй основную тему этого научного текста: {first_chunk}"
-    
+    return f"В одном предложении сформулируй основную тему этого научного текста: {first_chunk}"
+
+def build_relevance_prompt(topic: str, summary: str) -> str:
+    return f"""Оцени от 0 до 10, насколько следующая тема статьи релевантна теме исследования "{topic}".
+Тема статьи: {summary}
+Ответь ТОЛЬКО числом от 0 до 10."""
+
+def parse_score(content: str) -> int:
+    score = content.strip()
+    return int(score) if score.isdigit() else 0
+
+def get_article_summary(text: str, use_cache: bool = True) -> str:
+    """Получает свертку (основную тему) статьи из выборки текста."""
     try:
-        response = client.chat.completions.create(
-            model="deepseek/deepseek-v3.2",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=1.0,
-            max_tokens=100
-        )
-        return response.choices[0].message.content.strip()
+        return chat_completion(build_summary_prompt(text), max_tokens=100, use_cache=use_cache)
     except Exception as e:
         print(f"Ошибка получения summary: {e}")
         return ""
 
-def assess_relevance(topic: str, summary: str) -> int:
-    """Оценивает релевантность summary теме исследования. Возвращает оценку 0-10."""
+def assess_relevance(topic: str, summary: str, use_cache: bool = True) -> Optional[int]:
+    """
+    Оценивает релевантность summary теме исследования. Возвращает оценку 0-10
+    или None, если оценить не удалось (нет summary или LLM не ответила).
+    """
     if not summary:
-        return 0
-        
-    prompt = f"""Оцени от 0 до 10, насколько следующая тема статьи релевантна теме исследования "{topic}".
-Тема статьи: {summary}
-Ответь ТОЛЬКО числом от 0 до 10."""
+        return None
     
     try:
-        response = client.chat.completions.create(
-            model="deepseek/deepseek-v3.2",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=1.0,
-            max_tokens=3
-        )
-        score = response.choices[0].message.content.strip()
-        return int(score) if score.isdigit() else 0
+        return parse_score(chat_completion(build_relevance_prompt(topic, summary), max_tokens=3, use_cache=use_cache))
     except Exception as e:
         print(f"Ошибка оценки релевантности: {e}")
-        return 0
+        return None
+
+async def get_article_summary_async(async_client: AsyncOpenAI, text: str,
+                                    timeout: float = LLM_TIMEOUT, use_cache: bool = True,
+                                    deadline: Optional[float] = None) -> str:
+    """Асинхронная версия get_article_summary с ограничением времени ответа."""
+    try:
+        return await chat_completion_async(async_client, build_summary_prompt(text), max_tokens=100,
+                                    timeout=timeout, use_cache=use_cache, deadline=deadline)
+    except Exception as e:
+        print(f"Ошибка получения summary: {e!r}")
+        return ""
+
+async def assess_relevance_async(async_client: AsyncOpenAI, topic: str, summary: str,
+                                 timeout: float = LLM_TIMEOUT, use_cache: bool = True,
+                                 deadline: Optional[float] = None) -> Optional[int]:
+    """Асинхронная версия assess_relevance с ограничением времени ответа."""
+    if not summary:
+        return None
+    
+    try:
+        content = await chat_completion_async(async_client, build_relevance_prompt(topic, summary), max_tokens=3,
+                                       timeout=timeout, use_cache=use_cache, deadline=deadline)
+        return parse_score(content)
+    except Exception as e:
+        print(f"Ошибка оценки релевантности: {e!r}")
+        return None
+
+def build_batch_relevance_prompt(topic: str, summaries: List[str]) -> str:
+    numbered = "\n".join(f"{i}. {summary}" for i, summary in enumerate(summaries, start=1))
+    return f"""Оцени от 0 до 10, насколько каждая из следующих тем статей релевантна теме исследования "{topic}".
+Темы статей:
+{numbered}
+Ответь ТОЛЬКО JSON-объектом вида {{"1": оценка, "2": оценка, ...}} с оценкой для каждого номера, без пояснений."""
+
+def parse_batch_scores(content: str, count: int) -> Dict[int, int]:
+    """
+    Разбирает ответ пакетной оценки вида {"1": 7, "2": 3}.
+    Возвращает {номер_в_пакете: оценка} только для корректно разобранных номеров.
+    """
+    match = re.search(r"\{.*\}", content, re.DOTALL)
+    if not match:
+        return {}
+    try:
+        raw_scores = json.loads(match.group(0))
+    except ValueError:
+        return {}
+    
+    scores = {}
+    for key, value in raw_scores.items():
+        try:
+            position, score = int(key), int(value)
+        except (TypeError, ValueError):
+            continue
+        if 1 <= position <= count and 0 <= score <= 10:
+            scores[position] = score
+    return scores
+
+async def assess_relevance_batch_async(async_client: AsyncOpenAI, topic: str, summaries: Dict[int, str],
+                                       timeout: float = LLM_TIMEOUT, use_cache: bool = True,
+                                       deadline: Optional[float] = None,
+                                       semaphore: Optional[asyncio.Semaphore] = None) -> Dict[int, Optional[int]]:
+    """
+    Оценивает релевантность нескольких summary одним запросом.
+    - summaries: словарь {номер_файла: summary}
+    - semaphore: общее ограничение одновременных запросов; берется на пакетный запрос
+      и на каждый запасной, так что запасные запросы не превышают LLM_CONCURRENCY
+    Номера, для которых ответ не удалось разобрать, оцениваются по одному.
+    Возвращает словарь {номер_файла: оценка 0-10 или None, если оценить не удалось}.
+    """
+    indexes = [idx for idx, summary in summaries.items() if summary]
+    scores = {idx: None for idx in summaries if idx not in indexes}
+    if not indexes:
+        return scores
+    
+    semaphore = semaphore or asyncio.Semaphore(LLM_CONCURRENCY)
+    prompt = build_batch_relevance_prompt(topic, [summaries[idx] for idx in indexes])
+    parsed = {}
+    try:
+        async with semaphore:
+            content = await chat_completion_async(async_client, prompt, max_tokens=10 + 8 * len(indexes),
+                                                  timeout=timeout, use_cache=use_cache, deadline=deadline)
+        parsed = parse_batch_scores(content, len(indexes))
+    except Exception as e:
+        print(f"Ошибка пакетной оценки релевантности: {e!r}")
+    
+    for position, idx in enumerate(indexes, start=1):
+        if position in parsed:
+            scores[idx] = parsed[position]
+    
+    # Запасной вариант: по одному запросу на каждый неразобранный номер
+    fallback = [idx for idx in indexes if idx not in scores]
+    if fallback:
+        print(f"  Пакетная оценка не разобрана для {len(fallback)} файлов, оцениваю по одному")
+        
+        async def score_one(summary: str) -> Optional[int]:
+            async with semaphore:
+                return await assess_relevance_async(async_client, topic, summary, timeout, use_cache, deadline)
+        
+        results = await asyncio.gather(*(score_one(summaries[idx]) for idx in fallback))
+        scores.update(zip(fallback, results))
+    
+    return scores
+
+def prefilter_by_embeddings(topic: str, summaries: Dict[int, str],
+                            reject_similarity: float = EMBEDDING_REJECT_SIMILARITY) -> Tuple[Dict[int, int], Dict[int, float]]:
+    """
+    Предварительный отбор по косинусному сходству темы исследования и summary.
+    Файлы со сходством не выше reject_similarity считаются нерелевантными (оценка 0),
+    остальные отдаются LLM. Высокое сходство релевантность не решает: оценку 0-10
+    и порядок релевантных файлов ставит LLM.
+    Возвращает (отклоненные_локально {номер_файла: 0}, сходства {номер_файла: сходство}).
+    """
+    indexes = [idx for idx, summary in summaries.items() if summary]
+    if not indexes:
+        return {}, {}
+    
+    model = get_model()
+    embeddings = model.encode([topic] + [summaries[idx] for idx in indexes],
+                              convert_to_numpy=True, normalize_embeddings=True)
+    similarities = embeddings[1:] @ embeddings[0]
+    
+    decided = {idx: 0 for idx, similarity in zip(indexes, similarities) if similarity <= reject_similarity}
+    return decided, {idx: float(similarity) for idx, similarity in zip(indexes, similarities)}
+
+async def analyze_samples_async(samples: Dict[int, str], topic: str,
+                                concurrency: int = LLM_CONCURRENCY,
+                                timeout: float = LLM_TIMEOUT,
+                                batch_size: int = RELEVANCE_BATCH_SIZE,
+                                use_cache: bool = True,
+                                prefilter: bool = EMBEDDING_PREFILTER,
+                                summaries: Optional[Dict[int, str]] = None,
+                                budget: float = ANALYSIS_LLM_BUDGET) -> Dict[int, Tuple[str, Optional[int]]]:
+    """
+    Одновременно получает summary для всех файлов и оценивает их релевантность пакетами.
+    - samples: словарь {номер_файла: текст_для_анализа}
+    - concurrency: максимум одновременных запросов к LLM
+    - timeout: ограничение времени на один запрос, секунд
+    - batch_size: сколько summary оценивать одним запросом
+    - use_cache: использовать дисковый кэш ответов LLM
+    - prefilter: явно нерелевантные файлы отклонять по эмбеддингам без LLM
+    - summaries: уже известные summary {номер_файла: summary}, для них запрос summary не делается
+    - budget: секунд на все запросы вместе с повторами; после этого повторы не делаются,
+      а файлы без ответа получают пустое summary / оценку None
+    Возвращает словарь {номер_файла: (summary, оценка)}; оценка None - оценить не удалось.
+    """
+    deadline = time.monotonic() + budget
+    semaphore = asyncio.Semaphore(concurrency)
+    known_summaries = dict(summaries or {})
+    to_summarize = [idx for idx in samples if idx not in known_summaries]
+    indexes = sorted(set(samples) | set(known_summaries))
+    
+    async with create_async_client() as async_client:
+        async def summarize(text: str) -> str:
+            async with semaphore:
+                return await get_article_summary_async(async_client, text, timeout, use_cache, deadline)
+        
+        async def score_batch(batch: Dict[int, str]) -> Dict[int, Optional[int]]:
+            # Семафор берется внутри: на пакетный запрос и на каждый запасной
+            return await assess_relevance_batch_async(async_client, topic, batch, timeout, use_cache, deadline,
+                                                      semaphore)
+        
+        new_summaries = await asyncio.gather(*(summarize(samples[idx]) for idx in to_summarize))
+        summaries = {**known_summaries, **dict(zip(to_summarize, new_summaries))}
+        
+        scores = {}
+        if prefilter:
+            try:
+                scores, similarities = prefilter_by_embeddings(topic, summaries)
+                for idx in scores:
+                    print(f"  Файл #{idx}: сходство с темой {similarities[idx]:.2f}, нерелевантен без LLM")
+            except Exception as e:
+                print(f"Ошибка предварительного отбора по эмбеддингам: {e}")
+                scores = {}
+        
+        uncertain = [idx for idx in indexes if idx not in scores]
+        print(f"  Отклонено по эмбеддингам: {len(scores)}, на оценку LLM: {len(uncertain)}")
+        batches = [
+            {idx: summaries[idx] for idx in uncertain[i:i + batch_size]}
+            for i in range(0, len(uncertain), batch_size)
+        ]
+        for batch_scores in await asyncio.gather(*(score_batch(batch) for batch in batches)):
+            scores.update(batch_scores)
+    
+    return {idx: (summaries[idx], scores.get(idx)) for idx in indexes}
 
-def process_pdfs(folder_path: str, research_topic: str, actual_files) -> Tuple[Dict[int, str], List[int]]:
+def file_digests(pdf_paths: Dict[int, str]) -> Dict[int, str]:
+    """Считает SHA-256 файлов. Файлы, которые не удалось прочитать, пропускаются."""
+    digests = {}
+    for idx, pdf_path in pdf_paths.items():
+        try:
+            digests[idx] = file_sha256(pdf_path)
+        except Exception as e:
+            print(f"Ошибка хэширования {pdf_path}: {e}")
+    return digests
+
+def lookup_cached_pages(digests: Dict[int, str],
+                        text_cache: Optional[PdfTextCache]) -> Dict[int, List[str]]:
+    """Ищет постраничные тексты файлов в кэше по SHA-256."""
+    texts = {}
+    if text_cache is None:
+        return texts
+
+    for idx, digest in digests.items():
+        cached = text_cache.get(digest)
+        if cached is not None:
+            texts[idx] = cached
+
+    print(f"Кэш текстов PDF: {len(texts)} из {len(digests)} файлов найдено")
+    return texts
+
+def extract_and_cache(pdf_paths: Dict[int, str], digests: Dict[int, str],
+                      max_workers: int = PDF_WORKERS,
+                      text_cache: Optional[PdfTextCache] = None) -> Dict[int, List[str]]:
+    """
+    Полностью извлекает тексты файлов параллельно, сохраняет в кэш прочитанные без ошибок
+    и записывает статистику текста в хранилище сведений о документах.
+    """
+    texts, incomplete = extract_texts_parallel(pdf_paths, max_workers=max_workers)
+    for idx, pages in texts.items():
+        if idx not in digests:
+            continue
+        document_store.update(
+            digests[idx],
+            page_count=len(pages),
+            char_count=sum(len(page_text) for page_text in pages),
+            status=STATUS_OK if any(pages) else STATUS_NO_TEXT
+        )
+        # Пустой или неполный текст не кэшируем - это может быть временная ошибка чтения,
+        # иначе обрезанный документ достался бы всем следующим чатам
+        if text_cache is not None and any(pages) and idx not in incomplete:
+            text_cache.put(digests[idx], pages)
+    return texts
+
+def process_pdfs(folder_path: str, research_topic: str, actual_files,
+                 max_workers: int = PDF_WORKERS,
+                 text_cache: Optional[PdfTextCache] = None,
+                 triage: bool = PDF_TRIAGE) -> Tuple[Dict[int, List[str]], List[int], List[int]]:
     """
     Обрабатывает все PDF в папке:
-    - relevant_texts: словарь {номер_файла: полный_текст}
+    - relevant_texts: словарь {номер_файла: список_текстов_страниц}
     - irrelevant_files: список номеров нерелевантных файлов
+    - unscored_files: список номеров файлов, которые не удалось оценить (ошибки LLM,
+      исчерпан бюджет времени) - они не считаются ни релевантными, ни нерелевантными
     - actual_files: список из актуальных для определенного чата файлов
+    - max_workers: 1 - извлекать текст без пула процессов (размер общего пула - PDF_WORKERS)
+    - text_cache: кэш извлеченного текста (None - извлекать всегда заново)
+    - triage: оценивать релевантность по выборке страниц и извлекать полный текст
+      только у прошедших порог файлов
+    Для файлов, summary которых уже сохранено в document_store, извлечение
+    и summary пропускаются - пересчитывается только оценка релевантности.
+    Summary, полученное по выборке страниц, один раз пересчитывается по полному
+    тексту, когда тот появляется в кэше (после отбора файла как релевантного).
     """
     # Получаем список PDF файлов
     pdf_files_s = [f for f in os.listdir(folder_path) if f.lower().endswith('.pdf')]
@@ -106,59 +446,137 @@ def process_pdfs(folder_path: str, research_topic: str, actual_files) -> Tuple[D
     print(actual_files)
     if not pdf_files:
         print(f"В папке {folder_path} не найдено PDF файлов")
-        return {}, []
+        return {}, [], []
     
     print(f"Найдено {len(pdf_files)} PDF файлов")
     
     relevant_texts = {}
     irrelevant_files = []
+    unscored_files = []
+    
+    pdf_paths = {
+        idx: os.path.join(folder_path, pdf_file)
+        for idx, pdf_file in enumerate(pdf_files, start=1)
+    }
+    digests = file_digests(pdf_paths)
+    
+    full_texts = lookup_cached_pages(digests, text_cache)
+    
+    # Сохраненные ранее summary не зависят от темы, их можно переиспользовать.
+    # Summary по выборке страниц (в ней много списка литературы) пересчитывается,
+    # когда полный текст файла уже есть в кэше
+    records = document_store.get_many(digests.values())
+    known_summaries = {
+        idx: records[digest]["summary"]
+        for idx, digest in digests.items()
+        if digest in records and records[digest]["summary"]
+        and (records[digest]["summary_source"] == SUMMARY_FULL or idx not in full_texts)
+    }
+    print(f"Сохраненные summary найдены для {len(known_summaries)} из {len(pdf_paths)} файлов")
+    
+    # 1. Извлекаем текст файлов без summary параллельно: полный текст берем из кэша,
+    # для остальных в режиме триажа читаем только страницы для выборки
+    to_summarize = [idx for idx in pdf_paths if idx not in known_summaries]
+    sample_texts = {idx: full_texts[idx] for idx in to_summarize if idx in full_texts}
+    missing = {idx: pdf_paths[idx] for idx in to_summarize if idx not in full_texts}
+    if missing:
+        print(f"Извлечение текста ({min(max_workers, len(missing))} процессов, "
+              f"{'выборка страниц' if triage else 'полный текст'})...")
+        if triage:
+            sampled, _ = extract_texts_parallel(missing, max_workers, extract_sample_pages)
+            sample_texts.update(sampled)
+        else:
+            extracted = extract_and_cache(missing, digests, max_workers, text_cache)
+            full_texts.update(extracted)
+            sample_texts.update(extracted)
+    
+    # 2-3. Получаем свертку (summary) и оценку релевантности сразу для всех файлов
+    samples = {}
+    for idx, pages in sample_texts.items():
+        text = pages_to_text(pages)
+        if text:
+            samples[idx] = text
+    print(f"\nАнализ {len(samples) + len(known_summaries)} файлов (до {LLM_CONCURRENCY} запросов одновременно)...")
+    analysis = {}
+    if samples or known_summaries:
+        analysis = asyncio.run(analyze_samples_async(samples, research_topic, summaries=known_summaries))
+    print(f"Кэш ответов LLM: {response_cache.get_stats()}")
+    print(f"Запросы к LLM: {get_llm_stats()}")
+    
+    for idx in samples:
+        summary = analysis[idx][0]
+        if summary and idx in digests:
+            document_store.update(digests[idx], summary=summary,
+                                  summary_source=SUMMARY_FULL if idx in full_texts else SUMMARY_SAMPLE)
     
     for idx, pdf_file in enumerate(pdf_files, start=1):
-        file_path = os.path.join(folder_path, pdf_file)
         print(f"\nОбрабатываю файл #{idx}: {pdf_file}")
         
-        # 1. Извлекаем текст
-        text = extract_text_from_pdf(file_path)
-        if not text:
+        if idx not in analysis:
             print(f"  Не удалось извлечь текст, пропускаю")
+            if idx in digests:
+                document_store.update(digests[idx], status=STATUS_NO_TEXT)
             irrelevant_files.append(idx)
             continue
-            
-        # 2. Получаем свертку (summary)
-        summary = get_article_summary(text)
-        print(f"  Тема статьи: {summary}")
         
-        # 3. Оцениваем релевантность
-        score = assess_relevance(research_topic, summary)
+        summary, score = analysis[idx]
+        print(f"  Тема статьи: {summary}")
+        if score is None:
+            unscored_files.append(idx)
+            print(f"  ? Оценить релевантность не удалось, файл будет оценен при следующем запросе")
+            continue
         print(f"  Оценка релевантности: {score}/10")
         
-        # 4. Фильтруем (порог = 6)
-        if score >= 6:
-            relevant_texts[idx] = text
+        # 4. Фильтруем по порогу
+        if score >= RELEVANCE_THRESHOLD:
+            relevant_texts[idx] = full_texts.get(idx)
             print(f"  ✓ Сохранен как релевантный")
         else:
             irrelevant_files.append(idx)
             print(f"  ✗ Отклонен как нерелевантный")
     
-    return relevant_texts, irrelevant_files
-
+    # 5. Полный текст извлекаем только для прошедших отбор файлов
+    to_extract = {idx: pdf_paths[idx] for idx, pages in relevant_texts.items() if pages is None}
+    if to_extract:
+        print(f"\nПолное извлечение текста для {len(to_extract)} релевантных файлов...")
+        extracted = extract_and_cache(to_extract, digests, max_workers, text_cache)
+        for idx in to_extract:
+            relevant_texts[idx] = extracted.get(idx, [])
+    
+    return relevant_texts, irrelevant_files, unscored_files
 
-def initial_analyzis(RESEARCH_TOPIC, actual_files):
+def initial_analyzis(RESEARCH_TOPIC, actual_files, chat_id: Optional[int] = None):
     """
     - RESEARCH_TOPIC: тема исследования пользователя
     - actual_files: список из актуальных для определенного чата файлов
+    - chat_id: чат, в папку которого сохраняются результаты анализа
     """
-    relevant, irrelevant = process_pdfs(PDF_FOLDER, RESEARCH_TOPIC, actual_files)
+    relevant, irrelevant, unscored = process_pdfs(PDF_FOLDER, RESEARCH_TOPIC, actual_files,
+                                                  text_cache=pdf_text_cache)
 
-    with open('relevant_texts.json', 'w', encoding='utf-8') as f:
+    with open(artifact_path(chat_id, 'relevant_texts.json'), 'w', encoding='utf-8') as f:
         json.dump(relevant, f, ensure_ascii=False, indent=2)
-    with open('irrelevant_files.json', 'w', encoding='utf-8') as f:
+    with open(artifact_path(chat_id, 'irrelevant_files.json'), 'w', encoding='utf-8') as f:
         json.dump(irrelevant, f, indent=2)
+    with open(artifact_path(chat_id, 'unscored_files.json'), 'w', encoding='utf-8') as f:
+        json.dump(unscored, f, indent=2)
 
-    return f"""
+    result = f"""
 РЕЗУЛЬТАТ:
 Релевантных источников: {len(relevant)} (номера: {list(relevant.keys())})
 Нерелевантных источников: {len(irrelevant)} (номера: {irrelevant})
-            """
+"""
+    if unscored:
+        result += (f"Не удалось оценить (ошибки LLM): {len(unscored)} (номера: {unscored}), "
+                   f"анализ повторится при следующем запросе\n")
+    return result
+
+def has_unscored_files(chat_id: Optional[int] = None) -> bool:
+    """Остались ли после последнего анализа чата файлы без оценки релевантности."""
+    try:
+        with open(artifact_path(chat_id, 'unscored_files.json'), 'r', encoding='utf-8') as f:
+            return bool(json.load(f))
+    except (FileNotFoundError, ValueError):
+        return False
 
 # pdf_files = [f for f in os.listdir(UPLOADS_DIR) if f.lower().endswith('.pdf')]
\ No newline at end of file
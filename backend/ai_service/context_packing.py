@@ -0,0 +1,114 @@
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from ai_service.embeddings import get_model
+from ai_service.vectorizing import SENTENCE_BOUNDARY_RE
+
+CONTEXT_TOKEN_BUDGET = {"compact": 1200, "full": 2000}  # токенов контекста на режим обзора
+MMR_DIVERSITY = 0.3  # вес новизны в MMR: 0 - только сходство с запросом, 1 - только непохожесть на взятое
+SOURCE_REPEAT_PENALTY = 0.05  # снижение сходства за каждый уже взятый фрагмент того же источника
+MIN_TRIMMED_TOKENS = 40  # фрагмент короче этого при обрезке по предложению не добавляется
+
+
+def chunk_label(chunk: Dict) -> str:
+    """Ссылка на фрагмент в контексте промпта."""
+    return f"[#{chunk['source_id']}, p.~{chunk['approx_page']}]: "
+
+
+def mmr_rank(chunks: List[Dict], diversity: float = MMR_DIVERSITY,
+             penalty: float = SOURCE_REPEAT_PENALTY) -> List[Dict]:
+    """
+    Порядок фрагментов для контекста по maximal marginal relevance: на каждом шаге
+    берется фрагмент с наибольшим
+        (1 - diversity) * сходство_с_запросом - diversity * max(сходство с уже взятыми)
+    минус penalty за каждый уже взятый фрагмент того же источника.
+    Сходство между фрагментами считается по их эмбеддингам (ключ "embedding");
+    без эмбеддингов учитывается только повтор источника. Чанк, найденный несколькими
+    запросами, остается один раз - с лучшим сходством.
+    """
+    unique: Dict = {}
+    for chunk in chunks:
+        key = chunk.get('id') or (chunk['source_id'], chunk['approx_page'], chunk['text'])
+        if key not in unique or chunk['similarity_score'] > unique[key]['similarity_score']:
+            unique[key] = chunk
+    chunks = list(unique.values())
+    if not chunks:
+        return []
+
+    relevance = np.array([chunk['similarity_score'] for chunk in chunks], dtype=np.float32)
+    if all('embedding' in chunk for chunk in chunks):
+        embeddings = np.stack([chunk['embedding'] for chunk in chunks]).astype(np.float32)
+        embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        similarity = embeddings @ embeddings.T
+    else:
+        similarity = np.zeros((len(chunks), len(chunks)), dtype=np.float32)
+    sources = np.array([chunk['source_id'] for chunk in chunks])
+
+    redundancy = np.zeros(len(chunks), dtype=np.float32)  # наибольшее сходство с уже взятыми
+    source_taken = np.zeros(len(chunks), dtype=np.float32)  # сколько взято фрагментов источника чанка
+    available = np.ones(len(chunks), dtype=bool)
+    order = []
+    for _ in range(len(chunks)):
+        scores = (1 - diversity) * relevance - diversity * redundancy - penalty * source_taken
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        order.append(best)
+        available[best] = False
+        redundancy = np.maximum(redundancy, similarity[best])
+        source_taken += sources == sources[best]
+    return [chunks[i] for i in order]
+
+
+def trim_to_tokens(text: str, max_tokens: int, tokenizer, start: int = 0) -> str:
+    """
+    Начало text не длиннее max_tokens токенов, обрезанное по концу предложения
+    (граница ищется после позиции start; '' если ее нет).
+    """
+    offsets = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True, verbose=False)["offset_mapping"]
+    if len(offsets) <= max_tokens:
+        return text
+    limit = offsets[max_tokens][0]
+    boundaries = [match.end() for match in SENTENCE_BOUNDARY_RE.finditer(text, start, limit)]
+    return text[:boundaries[-1]].strip() if boundaries else ""
+
+
+def pack_context(chunks: List[Dict], mode: str, diversity: float = MMR_DIVERSITY) -> Tuple[str, int, List[Dict]]:
+    """
+    Собирает контекст промпта из найденных фрагментов в пределах бюджета токенов режима.
+    Фрагменты идут в порядке mmr_rank (с параметром diversity) и берутся целиком; не поместившийся фрагмент
+    обрезается по границе предложения, если от него остается хотя бы MIN_TRIMMED_TOKENS.
+    Токены считаются токенизатором модели эмбеддингов (вместе с метками источников).
+    Возвращает (контекст, использовано токенов, взятые фрагменты).
+    """
+    budget = CONTEXT_TOKEN_BUDGET[mode]
+    tokenizer = get_model().tokenizer
+    ranked = mmr_rank(chunks, diversity)
+
+    entries = [chunk_label(chunk) + chunk['text'] for chunk in ranked]
+    separator_tokens = len(tokenizer("\n\n", add_special_tokens=False, verbose=False)["input_ids"])
+    token_counts = []
+    if entries:
+        token_counts = [len(ids) for ids in tokenizer(entries, add_special_tokens=False, verbose=False)["input_ids"]]
+
+    parts, packed, used = [], [], 0
+    for chunk, entry, tokens in zip(ranked, entries, token_counts):
+        cost = tokens + (separator_tokens if parts else 0)
+        if used + cost > budget:
+            # Не помещается целиком: берем начало до конца предложения
+            available = budget - used - (separator_tokens if parts else 0)
+            if available < MIN_TRIMMED_TOKENS:
+                continue
+            # Точка в метке "p.~" - не конец предложения, ищем после метки
+            entry = trim_to_tokens(entry, available, tokenizer, start=len(chunk_label(chunk)))
+            tokens = len(tokenizer(entry, add_special_tokens=False, verbose=False)["input_ids"]) if entry else 0
+            if not MIN_TRIMMED_TOKENS <= tokens <= available:
+                continue
+            cost = tokens + (separator_tokens if parts else 0)
+        parts.append(entry)
+        packed.append(chunk)
+        used += cost
+
+    print(f"Контекст: {len(packed)} из {len(ranked)} фрагментов, {used} из {budget} токенов "
+          f"(режим {mode}, источников: {len({chunk['source_id'] for chunk in packed})})")
+    return "\n\n".join(parts), used, packed
@@ -0,0 +1,125 @@
+import os
+import re
+import zlib
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+
+DEDUP_NUM_PERM = 64  # хэш-функций в сигнатуре MinHash
+DEDUP_BANDS = 8  # полос LSH (по DEDUP_NUM_PERM // DEDUP_BANDS значений в полосе)
+DEDUP_THRESHOLD = 0.8  # оценка сходства Жаккара, начиная с которой чанк считается дубликатом
+SHINGLE_WORDS = 3  # слов в шингле
+DEDUP_SEED = 1  # seed коэффициентов хэш-функций: от него зависят сохраненные сигнатуры
+
+_MERSENNE_PRIME = (1 << 32) - 5  # простое < 2^32, чтобы a * x + b помещалось в uint64
+_WORD_RE = re.compile(r"\w+")
+
+
+def shingle_hashes(text: str, size: int = SHINGLE_WORDS) -> np.ndarray:
+    """Хэши словесных шинглов текста (регистр и пунктуация не учитываются)."""
+    words = _WORD_RE.findall(text.lower())
+    if len(words) < size:
+        shingles = {" ".join(words)}
+    else:
+        shingles = {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+    return np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles), dtype=np.uint64)
+
+
+class MinHashLSH:
+    """
+    Поиск почти-дубликатов: MinHash-сигнатуры словесных шинглов и LSH-индекс по полосам.
+    Кандидаты из общих корзин проверяются по доле совпавших значений сигнатуры
+    (оценка сходства Жаккара), так что проверяются только похожие пары, а не все.
+    """
+
+    def __init__(self, num_perm: int = DEDUP_NUM_PERM, bands: int = DEDUP_BANDS,
+                 threshold: float = DEDUP_THRESHOLD, seed: int = DEDUP_SEED):
+        if num_perm % bands:
+            raise ValueError("Число хэш-функций должно делиться на число полос")
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.buckets: List[Dict[bytes, List]] = [{} for _ in range(bands)]
+        self.signatures: Dict = {}
+
+    def signature(self, text: str) -> np.ndarray:
+        hashes = shingle_hashes(text)
+        return ((self.a[:, None] * hashes[None, :] + self.b[:, None]) % _MERSENNE_PRIME).min(axis=1)
+
+    def _band_keys(self, signature: np.ndarray) -> Iterable[Tuple[int, bytes]]:
+        for band in range(self.bands):
+            yield band, signature[band * self.rows:(band + 1) * self.rows].tobytes()
+
+    def add(self, key, signature: np.ndarray) -> None:
+        self.signatures[key] = signature
+        for band, band_key in self._band_keys(signature):
+            self.buckets[band].setdefault(band_key, []).append(key)
+
+    def query(self, signature: np.ndarray):
+        """Первый добавленный ключ, похожий на signature не меньше threshold, или None."""
+        checked = set()
+        for band, band_key in self._band_keys(signature):
+            for key in self.buckets[band].get(band_key, ()):
+                if key in checked:
+                    continue
+                checked.add(key)
+                if np.mean(self.signatures[key] == signature) >= self.threshold:
+                    return key
+        return None
+
+
+def find_near_duplicates(texts: Iterable[str], existing: Optional[Dict[str, np.ndarray]] = None,
+                         threshold: float = DEDUP_THRESHOLD) -> Tuple[Dict[int, Union[int, str]], List[np.ndarray]]:
+    """
+    Ищет почти-дубликаты среди texts и относительно уже проиндексированных чанков.
+    - existing: {id_чанка: MinHash-сигнатура} чанков, которые уже есть в индексе
+    Возвращает ({индекс_дубликата_в_texts: оригинал}, сигнатуры texts), где оригинал -
+    индекс в texts (более ранний чанк) или id существующего чанка. Из группы похожих остается первый.
+    """
+    lsh = MinHashLSH(threshold=threshold)
+    for chunk_id, signature in (existing or {}).items():
+        lsh.add(chunk_id, signature)
+
+    duplicates = {}
+    signatures = []
+    for i, text in enumerate(texts):
+        signature = lsh.signature(text)
+        signatures.append(signature)
+        original = lsh.query(signature)
+        if original is None:
+            lsh.add(i, signature)
+        else:
+            duplicates[i] = original
+    return duplicates, signatures
+
+
+def load_signatures(path: Path) -> Dict[str, np.ndarray]:
+    """
+    Сохраненные рядом с индексом сигнатуры {id_чанка: сигнатура}; пустой словарь,
+    если файла нет или он посчитан с другими параметрами MinHash.
+    """
+    try:
+        with np.load(path) as data:
+            ids, signatures, params = data["ids"], data["signatures"], data["params"]
+    except (OSError, ValueError, KeyError):
+        return {}
+    if params.tolist() != [DEDUP_NUM_PERM, DEDUP_SEED]:
+        return {}
+    return dict(zip(ids.tolist(), signatures))
+
+
+def save_signatures(path: Path, signatures: Dict[str, np.ndarray]) -> None:
+    """Атомарно сохраняет сигнатуры чанков индекса (см. load_signatures)."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp.npz")
+    ids = list(signatures)
+    matrix = np.stack([signatures[chunk_id] for chunk_id in ids]) if ids else np.zeros((0, DEDUP_NUM_PERM), np.uint64)
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, ids=np.array(ids, dtype=str), signatures=matrix,
+                 params=np.array([DEDUP_NUM_PERM, DEDUP_SEED]))
+    os.replace(tmp_path, path)
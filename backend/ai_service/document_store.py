@@ -0,0 +1,95 @@
+import sqlite3
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, Iterator
+
+BASE_DIR = Path(__file__).parent.parent  # поднимаемся из ai_service в backend
+DOCUMENT_STORE_PATH = BASE_DIR / "cache" / "documents.db"
+
+# Статусы извлечения текста
+STATUS_OK = "ok"
+STATUS_NO_TEXT = "no_text"
+
+# Из какого текста получено summary
+SUMMARY_SAMPLE = "sample"  # выборка страниц триажа (начало, середина, конец со списком литературы)
+SUMMARY_FULL = "full"  # полный текст
+
+DOCUMENT_FIELDS = ("summary", "summary_source", "page_count", "char_count", "status")
+
+
+class DocumentStore:
+    """
+    Сведения о документах, не зависящие от темы исследования: summary,
+    статистика текста и статус извлечения. Ключ - SHA-256 байтов PDF,
+    поэтому при смене темы (или повторной загрузке того же файла в другой чат)
+    извлечение и summary не повторяются, а пересчитывается только оценка релевантности.
+    summary_source отмечает, получено summary по выборке страниц или по полному тексту:
+    summary по выборке заменяется, как только полный текст документа оказывается в кэше.
+    """
+
+    def __init__(self, db_path: Path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS documents (
+                    sha256 TEXT PRIMARY KEY,
+                    summary TEXT,
+                    page_count INTEGER,
+                    char_count INTEGER,
+                    status TEXT,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            columns = [column[1] for column in conn.execute("PRAGMA table_info(documents)")]
+            if "summary_source" not in columns:
+                # Для записей старого формата источник неизвестен - summary пересчитается по полному тексту
+                conn.execute("ALTER TABLE documents ADD COLUMN summary_source TEXT")
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get_many(self, digests: Iterable[str]) -> Dict[str, Dict]:
+        """Возвращает {sha256: запись} для найденных документов."""
+        digests = list(set(digests))
+        if not digests:
+            return {}
+        placeholders = ",".join("?" * len(digests))
+        try:
+            with self._connect() as conn:
+                rows = conn.execute(
+                    f"SELECT * FROM documents WHERE sha256 IN ({placeholders})", digests
+                ).fetchall()
+        except sqlite3.Error as e:
+            print(f"Ошибка чтения сведений о документах: {e}")
+            return {}
+        return {row["sha256"]: dict(row) for row in rows}
+
+    def update(self, digest: str, **fields) -> None:
+        """Создает или дополняет запись о документе (None-поля не затирают сохраненные)."""
+        fields = {k: v for k, v in fields.items() if k in DOCUMENT_FIELDS and v is not None}
+        if not fields:
+            return
+        columns = ", ".join(fields)
+        placeholders = ", ".join("?" * len(fields))
+        updates = ", ".join(f"{column} = excluded.{column}" for column in fields)
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    f"INSERT INTO documents (sha256, {columns}, updated_at) VALUES (?, {placeholders}, ?) "
+                    f"ON CONFLICT(sha256) DO UPDATE SET {updates}, updated_at = excluded.updated_at",
+                    (digest, *fields.values(), time.time())
+                )
+        except sqlite3.Error as e:
+            print(f"Ошибка записи сведений о документе: {e}")
+
+
+document_store = DocumentStore(DOCUMENT_STORE_PATH)
@@ -0,0 +1,292 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Tuple
+
+import numpy as np
+from filelock import FileLock
+
+BASE_DIR = Path(__file__).parent.parent  # поднимаемся из ai_service в backend
+EMBEDDING_CACHE_DIR = BASE_DIR / "cache" / "embeddings"
+EMBEDDING_LOOKUP_BATCH = 500  # ключей в одном SELECT ... IN (...)
+EMBEDDING_CACHE_MAX_ROWS = 200000  # максимум векторов в кэше модели (~300 МБ при размерности 384)
+EMBEDDING_CACHE_KEEP_FRACTION = 0.75  # доля max_rows, остающаяся после сжатия файла
+EMBEDDING_CACHE_LOCK_TIMEOUT = 60  # секунд ожидания межпроцессной блокировки кэша
+
+
+def text_hash(text: str) -> str:
+    """Ключ чанка в кэше - SHA-256 его текста."""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Персистентный кэш эмбеддингов одной модели.
+    Векторы лежат подряд в файле vectors.f32 (float32, строка на вектор) и читаются
+    через np.memmap, индекс {хэш_текста: номер_строки} хранится в SQLite.
+    При повторной индексации тех же чанков (смена темы, перезапуск, другой чат
+    с теми же статьями) модель не вызывается.
+    Новые векторы дописываются в конец файла. Когда строк становится больше max_rows,
+    файл сжимается: в новое поколение файла переписываются keep_fraction * max_rows
+    векторов, к которым обращались позже остальных (LRU), остальные вытесняются.
+    Кэш могут использовать несколько процессов сервера (uvicorn --workers N): восстановление,
+    дописывание, сжатие и чтение идут под файловой блокировкой cache.lock, а перед каждой
+    операцией процесс сверяет номер поколения файла с индексом (его мог сжать другой процесс).
+    Чтение копирует из отображенного файла только запрошенные строки.
+    """
+
+    def __init__(self, cache_dir: Path, model_name: str, dim: int, max_rows: int = EMBEDDING_CACHE_MAX_ROWS,
+                 keep_fraction: float = EMBEDDING_CACHE_KEEP_FRACTION):
+        self.model_name = model_name
+        self.dim = dim
+        self.max_rows = max_rows
+        self.keep_rows = max(1, int(max_rows * keep_fraction))
+        # Отдельная папка на модель: векторы разных моделей несовместимы
+        self.dir = Path(cache_dir) / re.sub(r"[^\w.-]+", "_", model_name)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.dir / "index.db"
+        self.row_bytes = dim * np.dtype(np.float32).itemsize
+        self.stats = {"hits": 0, "misses": 0, "evicted": 0}
+        self._lock = threading.Lock()  # между потоками процесса
+        self._file_lock = FileLock(str(self.dir / "cache.lock"), timeout=EMBEDDING_CACHE_LOCK_TIMEOUT)
+        self._memmap = None
+        self.generation = 0
+        self.vectors_path = self._vectors_path(0)
+        with self._lock, self._file_lock:
+            self._init_index()
+            self._repair()
+
+    def _init_index(self) -> None:
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS vectors (key TEXT PRIMARY KEY, row INTEGER NOT NULL)")
+            columns = [column[1] for column in conn.execute("PRAGMA table_info(vectors)")]
+            if "accessed_at" not in columns:
+                # Кэш старого формата: время обращения неизвестно, такие векторы вытесняются первыми
+                conn.execute("ALTER TABLE vectors ADD COLUMN accessed_at REAL NOT NULL DEFAULT 0")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_vectors_accessed ON vectors (accessed_at)")
+            # Поколение файла векторов меняется при каждом сжатии вместе с индексом, в одной транзакции
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._sync_generation()
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.index_path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _vectors_path(self, generation: int) -> Path:
+        # Поколение 0 - имя файла из версии кэша без сжатия
+        return self.dir / ("vectors.f32" if generation == 0 else f"vectors.{generation}.f32")
+
+    def _sync_generation(self) -> None:
+        """
+        Переключается на текущее поколение файла векторов из индекса, если его сменило
+        сжатие в другом процессе. Вызывается под self._lock и self._file_lock.
+        """
+        with self._connect() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE name = 'generation'").fetchone()
+        generation = row[0] if row else 0
+        if generation != self.generation:
+            self._memmap = None
+            self.generation, self.vectors_path = generation, self._vectors_path(generation)
+
+    def _rows_on_disk(self) -> int:
+        return self.vectors_path.stat().st_size // self.row_bytes if self.vectors_path.exists() else 0
+
+    def _repair(self) -> None:
+        """
+        Удаляет файлы векторов других поколений (сжатие, прерванное до или после
+        переключения индекса), отрезает недописанный хвост файла и записи индекса,
+        указывающие за его конец (после сбоя). Вызывается под self._file_lock.
+        """
+        for path in self.dir.glob("vectors*.f32"):
+            if path != self.vectors_path:
+                try:
+                    path.unlink()
+                except OSError as e:
+                    # На Windows файл может быть еще отображен в память другим процессом
+                    print(f"Ошибка удаления {path}: {e}")
+        if self.vectors_path.exists():
+            size = self.vectors_path.stat().st_size
+            if size % self.row_bytes:
+                os.truncate(self.vectors_path, size - size % self.row_bytes)
+        with self._connect() as conn:
+            conn.execute("DELETE FROM vectors WHERE row >= ?", (self._rows_on_disk(),))
+
+    def _vectors(self) -> np.ndarray:
+        """Отображение файла векторов в память; пересоздается, когда файл вырос."""
+        rows = self._rows_on_disk()
+        if self._memmap is None or len(self._memmap) != rows:
+            self._memmap = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(rows, self.dim))
+        return self._memmap
+
+    def lookup(self, keys: List[str]) -> Dict[str, int]:
+        """Возвращает {ключ: номер_строки} для найденных в кэше ключей и отмечает обращение к ним."""
+        rows = {}
+        unique = list(set(keys))
+        now = time.time()
+        with self._connect() as conn:
+            for i in range(0, len(unique), EMBEDDING_LOOKUP_BATCH):
+                batch = unique[i:i + EMBEDDING_LOOKUP_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                rows.update(conn.execute(
+                    f"SELECT key, row FROM vectors WHERE key IN ({placeholders})", batch
+                ).fetchall())
+                # Отмечаем обращение для LRU
+                conn.execute(f"UPDATE vectors SET accessed_at = ? WHERE key IN ({placeholders})", [now, *batch])
+        return rows
+
+    def _read_rows(self, keys: List[str]) -> Tuple[Dict[str, int], np.ndarray]:
+        """
+        Найденные ключи и их векторы (строки матрицы - в порядке found_keys).
+        Поиск в индексе и чтение файла идут под одной блокировкой, чтобы сжатие
+        (в этом или другом процессе) не переписало файл между ними.
+        """
+        with self._lock, self._file_lock:
+            self._sync_generation()
+            cached = self.lookup(keys)
+            found_keys = list(cached)
+            if found_keys:
+                vectors = np.asarray(self._vectors()[[cached[key] for key in found_keys]])
+            else:
+                vectors = np.zeros((0, self.dim), dtype=np.float32)
+        return {key: i for i, key in enumerate(found_keys)}, vectors
+
+    def append(self, keys: List[str], vectors: np.ndarray) -> None:
+        """
+        Дописывает векторы в конец файла и регистрирует их в индексе.
+        Если строк в файле стало больше max_rows, сжимает кэш.
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        now = time.time()
+        with self._lock, self._file_lock:
+            self._sync_generation()
+            first_row = self._rows_on_disk()
+            with open(self.vectors_path, 'ab') as f:
+                f.write(vectors.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            # Индекс пишем после данных: запись в индексе всегда указывает на дописанный вектор
+            with self._connect() as conn:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO vectors (key, row, accessed_at) VALUES (?, ?, ?)",
+                    ((key, first_row + i, now) for i, key in enumerate(keys))
+                )
+            if first_row + len(vectors) > self.max_rows:
+                self._compact()
+
+    def _compact(self) -> None:
+        """
+        Переписывает keep_rows последних по обращению векторов в файл следующего поколения
+        и переключает на него индекс. Вызывается под self._lock и self._file_lock.
+        """
+        with self._connect() as conn:
+            kept = conn.execute(
+                "SELECT key, row, accessed_at FROM vectors ORDER BY accessed_at DESC LIMIT ?", (self.keep_rows,)
+            ).fetchall()
+            total = conn.execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+        kept.sort(key=lambda entry: entry[1])  # читаем старый файл по порядку строк
+
+        generation = self.generation + 1
+        new_path = self._vectors_path(generation)
+        old_vectors = self._vectors()
+        with open(new_path, 'wb') as f:
+            for start in range(0, len(kept), EMBEDDING_LOOKUP_BATCH):
+                rows = [entry[1] for entry in kept[start:start + EMBEDDING_LOOKUP_BATCH]]
+                f.write(np.ascontiguousarray(old_vectors[rows]).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        # Индекс и номер поколения меняются в одной транзакции: после сбоя до нее остается
+        # старый файл, после - новый (лишний удалит _repair при следующем запуске)
+        with self._connect() as conn:
+            conn.execute("DELETE FROM vectors")
+            conn.executemany(
+                "INSERT INTO vectors (key, row, accessed_at) VALUES (?, ?, ?)",
+                ((key, new_row, accessed_at) for new_row, (key, _, accessed_at) in enumerate(kept))
+            )
+            conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('generation', ?)", (generation,))
+
+        old_path = self.vectors_path
+        self._memmap = None
+        del old_vectors
+        self.generation, self.vectors_path = generation, new_path
+        try:
+            old_path.unlink()
+        except OSError as e:
+            print(f"Ошибка удаления {old_path}: {e}")
+        self.stats["evicted"] += total - len(kept)
+        print(f"Кэш эмбеддингов: вытеснено {total - len(kept)} векторов, осталось {len(kept)}")
+
+    def read(self, texts: List[str]) -> Tuple[np.ndarray, List[bool]]:
+        """Векторы texts из кэша без вызова модели: (матрица, признаки наличия; отсутствующие - нули)."""
+        keys = [text_hash(text) for text in texts]
+        result = np.zeros((len(texts), self.dim), dtype=np.float32)
+        try:
+            cached, vectors = self._read_rows(keys)
+        except (OSError, sqlite3.Error) as e:
+            print(f"Ошибка чтения кэша эмбеддингов: {e}")
+            return result, [False] * len(texts)
+        found = [key in cached for key in keys]
+        positions = [i for i, ok in enumerate(found) if ok]
+        if positions:
+            result[positions] = vectors[[cached[keys[i]] for i in positions]]
+        return result, found
+
+    def encode(self, encode_fn: Callable[[List[str]], np.ndarray], texts: List[str]) -> np.ndarray:
+        """
+        Эмбеддинги для texts: найденные в кэше читаются из файла,
+        encode_fn (модель) считает только промахи, и они сразу дописываются в кэш.
+        """
+        keys = [text_hash(text) for text in texts]
+        try:
+            cached, cached_vectors = self._read_rows(keys)
+        except (OSError, sqlite3.Error) as e:
+            print(f"Ошибка чтения кэша эмбеддингов: {e}")
+            cached = {}
+
+        result = np.empty((len(texts), self.dim), dtype=np.float32)
+        hit_positions = [i for i, key in enumerate(keys) if key in cached]
+        if hit_positions:
+            result[hit_positions] = cached_vectors[[cached[keys[i]] for i in hit_positions]]
+
+        # Одинаковые тексты внутри батча считаем один раз
+        miss_positions: Dict[str, List[int]] = {}
+        for i, key in enumerate(keys):
+            if key not in cached:
+                miss_positions.setdefault(key, []).append(i)
+        if miss_positions:
+            miss_keys = list(miss_positions)
+            miss_texts = [texts[miss_positions[key][0]] for key in miss_keys]
+            vectors = np.asarray(encode_fn(miss_texts), dtype=np.float32)
+            for key, vector in zip(miss_keys, vectors):
+                result[miss_positions[key]] = vector
+            try:
+                self.append(miss_keys, vectors)
+            except (OSError, sqlite3.Error) as e:
+                print(f"Ошибка записи кэша эмбеддингов: {e}")
+
+        with self._lock:
+            self.stats["hits"] += len(hit_positions)
+            self.stats["misses"] += len(keys) - len(hit_positions)
+        print(f"Кэш эмбеддингов: {len(hit_positions)} из {len(texts)} векторов взяты из кэша")
+        return result
+
+
+_caches: Dict[str, EmbeddingCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_embedding_cache(model_name: str, dim: int) -> EmbeddingCache:
+    """Кэш эмбеддингов модели (один объект на модель в процессе)."""
+    with _caches_lock:
+        if model_name not in _caches:
+            _caches[model_name] = EmbeddingCache(EMBEDDING_CACHE_DIR, model_name, dim)
+        return _caches[model_name]
@@ -0,0 +1,113 @@
+import atexit
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+from sentence_transformers import SentenceTransformer
+
+EMBEDDING_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+EMBEDDING_BATCH_SIZE = 64  # текстов в батче модели
+EMBEDDING_BUCKET_BATCHES = 16  # батчей в одной группе текстов близкой длины
+EMBEDDING_WORKERS = 1  # процессов для encode; > 1 - пул процессов sentence-transformers (только CPU)
+EMBEDDING_POOL_MIN_TEXTS = 2000  # с какого числа текстов имеет смысл пул процессов
+
+_models: Dict[str, SentenceTransformer] = {}
+_models_lock = threading.Lock()
+_load_locks: Dict[str, threading.Lock] = {}
+
+
+def get_model(name: str = EMBEDDING_MODEL) -> SentenceTransformer:
+    """
+    Возвращает модель эмбеддингов из общего реестра процесса.
+    Каждая модель загружается с диска один раз; пока она грузится, другие потоки,
+    которым нужна та же модель, ждут, а запросы к уже загруженным моделям не блокируются.
+    """
+    model = _models.get(name)
+    if model is not None:
+        return model
+
+    with _models_lock:
+        load_lock = _load_locks.setdefault(name, threading.Lock())
+    with load_lock:
+        model = _models.get(name)
+        if model is None:
+            started = time.perf_counter()
+            model = SentenceTransformer(name)
+            _models[name] = model
+            print(f"Модель эмбеддингов {name} загружена за {time.perf_counter() - started:.1f} с")
+    return model
+
+
+def warm_up(names: Iterable[str] = (EMBEDDING_MODEL,)) -> None:
+    """Загружает модели заранее (при старте сервера) и прогоняет пробный encode."""
+    for name in names:
+        get_model(name).encode(["прогрев"], convert_to_numpy=True)
+
+
+_pools: Dict[str, dict] = {}
+_pools_lock = threading.Lock()
+
+
+def get_process_pool(name: str = EMBEDDING_MODEL, workers: int = EMBEDDING_WORKERS) -> Optional[dict]:
+    """
+    Пул процессов sentence-transformers для модели (запускается один раз и живет до выхода).
+    Каждый процесс держит свою копию модели, поэтому пул включается только явно.
+    """
+    if workers <= 1:
+        return None
+    with _pools_lock:
+        if name not in _pools:
+            print(f"Запуск пула из {workers} процессов для эмбеддингов...")
+            pool = get_model(name).start_multi_process_pool(target_devices=["cpu"] * workers)
+            _pools[name] = pool
+            atexit.register(SentenceTransformer.stop_multi_process_pool, pool)
+        return _pools[name]
+
+
+def length_buckets(texts: List[str], bucket_size: int) -> List[List[int]]:
+    """
+    Индексы texts, отсортированные по длине и нарезанные на группы по bucket_size:
+    в одном батче оказываются тексты близкой длины и паддинг минимален.
+    """
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]), reverse=True)
+    return [order[i:i + bucket_size] for i in range(0, len(order), bucket_size)]
+
+
+def encode_texts(model: SentenceTransformer, texts: List[str], batch_size: int = EMBEDDING_BATCH_SIZE,
+                 workers: int = EMBEDDING_WORKERS, name: str = EMBEDDING_MODEL,
+                 show_progress_bar: bool = False) -> np.ndarray:
+    """
+    Эмбеддинги большого списка текстов: группы текстов близкой длины, настраиваемый
+    размер батча и, для больших объемов, пул процессов. Печатает скорость в чанках/с.
+    Результат - float32-матрица в порядке texts.
+    """
+    if not texts:
+        return np.zeros((0, model.get_sentence_embedding_dimension()), dtype=np.float32)
+
+    started = time.perf_counter()
+    pool = get_process_pool(name, workers) if len(texts) >= EMBEDDING_POOL_MIN_TEXTS else None
+    result = np.empty((len(texts), model.get_sentence_embedding_dimension()), dtype=np.float32)
+
+    if pool is not None:
+        # Пул сам делит вход на куски по процессам; сортировка по длине дает каждому
+        # процессу однородные по длине куски
+        order = [i for bucket in length_buckets(texts, len(texts)) for i in bucket]
+        vectors = model.encode_multi_process([texts[i] for i in order], pool, batch_size=batch_size,
+                                             chunk_size=batch_size * EMBEDDING_BUCKET_BATCHES)
+        result[order] = vectors
+    else:
+        buckets = length_buckets(texts, batch_size * EMBEDDING_BUCKET_BATCHES)
+        done = 0
+        for bucket in buckets:
+            result[bucket] = model.encode([texts[i] for i in bucket], batch_size=batch_size,
+                                          convert_to_numpy=True, show_progress_bar=False)
+            done += len(bucket)
+            if show_progress_bar and len(buckets) > 1:
+                elapsed = time.perf_counter() - started
+                print(f"  Эмбеддинги: {done}/{len(texts)} ({done / elapsed:.0f} чанков/с)")
+
+    elapsed = time.perf_counter() - started
+    print(f"Эмбеддинги: {len(texts)} текстов за {elapsed:.1f} с ({len(texts) / max(elapsed, 1e-9):.0f} чанков/с, "
+          f"батч {batch_size}, процессов {workers if pool is not None else 1})")
+    return result
@@ -1,12 +1,32 @@
 import json
-from typing import Dict, List, Tuple
-from openai import OpenAI
-from sentence_transformers import SentenceTransformer
-import chromadb
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+import numpy as np
 import re
-import config as cn
+from ai_service.chat_workspace import artifact_path
+from ai_service.context_packing import pack_context
+from ai_service.embeddings import get_model
+from ai_service.llm_cache import response_cache
+from ai_service.llm_client import chat_completion, chat_completion_stream
+from ai_service.llm_client import get_stats as get_llm_stats
+from ai_service.vector_store import open_vector_store
 
-client = OpenAI(api_key=cn.DEEPSEEK_API_KEY, base_url="https://openrouter.ai/api/v1")
+# Запросы, по которым собирается контекст обзора (по ключевым аспектам)
+SEARCH_QUERIES = [
+    "теория концепция подход",
+    "методология исследование метод",
+    "дискуссия противоречие разногласие",
+    "хронология развитие история эволюция темы",
+    "результат вывод исследование",
+    "пробел ограничение"
+]
+
+GENERATION_LLM_BUDGET = 150  # секунд на запрос обзора к LLM с повторами (шаг генерации ограничен 180 с)
+REWRITE_LLM_BUDGET = 100  # то же для переписывания обзора (шаг ограничен 120 с)
+
+_query_embeddings: Dict[str, np.ndarray] = {}
+_query_embeddings_lock = threading.Lock()
 
 def extract_citations(text: str) -> List[Tuple[int, int]]:
     """
@@ -38,52 +58,91 @@ def extract_citations(text: str) -> List[Tuple[int, int]]:
     
     return list(set(citations))  # Убираем дубликаты
 
-def search_in_vector_db(query: str, n_results: int = 5) -> List[Dict]:
+def encode_queries(queries: List[str]) -> np.ndarray:
     """
-    Ищет релевантные чанки в векторной базе.
+    Эмбеддинги поисковых запросов одним вызовом encode.
+    Запросы из SEARCH_QUERIES считаются один раз на процесс и берутся из памяти.
     """
-    try:
-        client = chromadb.PersistentClient(path="./chroma_db")
-        collection = client.get_collection("research_papers")
-    except:
-        print("Ошибка: векторная база не найдена!")
+    vectors = {}
+    missing = []
+    for query in dict.fromkeys(queries):
+        if query in _query_embeddings:
+            vectors[query] = _query_embeddings[query]
+        else:
+            missing.append(query)
+    
+    if missing:
+        for query, vector in zip(missing, get_model().encode(missing, convert_to_numpy=True)):
+            vectors[query] = vector
+            if query in SEARCH_QUERIES:
+                with _query_embeddings_lock:
+                    _query_embeddings[query] = vector
+    
+    return np.stack([vectors[query] for query in queries])
+
+def warm_up_search_queries() -> None:
+    """Заранее считает эмбеддинги фиксированных запросов (вызывается при старте сервера)."""
+    encode_queries(SEARCH_QUERIES)
+
+def search_many_in_vector_db(queries: List[str], n_results: int = 5, chat_id: Optional[int] = None,
+                             include_embeddings: bool = False) -> List[List[Dict]]:
+    """
+    Пакетный поиск: все запросы кодируются одним encode и отправляются
+    одним запросом к векторному индексу чата. Возвращает списки чанков в порядке запросов.
+    С include_embeddings у чанков есть ключ "embedding" (для MMR при сборке контекста).
+    """
+    if not queries:
         return []
-    
-    embedding_model = SentenceTransformer("sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
-    query_embedding = embedding_model.encode([query], convert_to_numpy=True)
-    
-    results = collection.query(
-        query_embeddings=query_embedding.tolist(),
-        n_results=n_results,
-        include=["documents", "metadatas", "distances"]
-    )
-    
-    similar_chunks = []
-    if results['documents']:
-        for i in range(len(results['documents'][0])):
-            similar_chunks.append({
-                "text": results['documents'][0][i],
-                "source_id": results['metadatas'][0][i]["source_id"],
-                "approx_page": results['metadatas'][0][i]["approx_page"]
-            })
-    
-    return similar_chunks
+    store = open_vector_store(chat_id)
+    if store is None:
+        print("Ошибка: векторная база не найдена!")
+        return [[] for _ in queries]
+    
+    query_embeddings = encode_queries(queries)
+    
+    return [
+        [
+            {
+                "id": match["id"],
+                "text": match["text"],
+                "source_id": match["metadata"]["source_id"],
+                "approx_page": match["metadata"]["approx_page"],
+                "similarity_score": match["similarity"],
+                **({"embedding": match["embedding"]} if include_embeddings else {})
+            }
+            for match in matches
+        ]
+        for matches in store.query(query_embeddings, n_results, include_embeddings)
+    ]
 
-def call_deepseek(prompt: str, max_tokens: int = 2000, temperature: float = 1.0) -> str:
+def search_in_vector_db(query: str, n_results: int = 5, chat_id: Optional[int] = None) -> List[Dict]:
+    """
+    Ищет релевантные чанки в векторной коллекции чата.
+    """
+    return search_many_in_vector_db([query], n_results, chat_id)[0]
+
+def call_deepseek(prompt: str, max_tokens: int = 2000, temperature: float = 1.0, use_cache: bool = True,
+                  on_delta: Optional[Callable[[str], None]] = None,
+                  budget: float = GENERATION_LLM_BUDGET) -> str:
+    """
+    Запрос к LLM. С on_delta ответ генерируется потоково и фрагменты текста
+    передаются в on_delta по мере появления. budget - секунд на запрос вместе с повторами.
+    """
+    deadline = time.monotonic() + budget
     try:
-        response = client.chat.completions.create(
-            model="deepseek/deepseek-v3.2",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=temperature,
-            max_tokens=max_tokens
-        )
-        result = response.choices[0].message.content.strip()
-        return result
+        if on_delta is not None:
+            return chat_completion_stream(prompt, on_delta, max_tokens=max_tokens, temperature=temperature,
+                                          use_cache=use_cache, deadline=deadline)
+        return chat_completion(prompt, max_tokens=max_tokens, temperature=temperature, use_cache=use_cache,
+                               deadline=deadline)
     except Exception as e:
-        print(f"Ошибка оценки релевантности: {e}")
+        print(f"Ошибка генерации: {e}")
         return ""
+    finally:
+        print(f"Кэш ответов LLM: {response_cache.get_stats()}, запросы к LLM: {get_llm_stats()}")
 
-def generate_compact_review(RESEARCH_TOPIC) -> Tuple[str, List[int], List[int]]:
+def generate_compact_review(RESEARCH_TOPIC, chat_id: Optional[int] = None,
+                            on_delta: Optional[Callable[[str], None]] = None) -> Tuple[str, List[int], List[int]]:
     """
     Генерирует компактный аналитический обзор без явных разделов.
     """
@@ -94,37 +153,16 @@ def generate_compact_review(RESEARCH_TOPIC) -> Tuple[str, List[int], List[int]]:
     # 1. Сначала собираем ключевую информацию из источников
     print("\n[Шаг 1] Сбор ключевой информации из источников...")
     
-    # Ищем информацию по ключевым аспектам
-    search_queries = [
-        "теория концепция подход",
-        "методология исследование метод",
-        "дискуссия противоречие разногласие",
-        "хронология развитие история эволюция темы",
-        "результат вывод исследование",
-        "пробел ограничение"
-    ]
-    
+    # Ищем информацию по ключевым аспектам одним пакетным запросом
     all_relevant_chunks = []
-    for query in search_queries:
-        chunks = search_in_vector_db(query, n_results=4)
+    results = search_many_in_vector_db(SEARCH_QUERIES, n_results=4, chat_id=chat_id, include_embeddings=True)
+    for query, chunks in zip(SEARCH_QUERIES, results):
         all_relevant_chunks.extend(chunks)
         print(f"  Поиск '{query}': найдено {len(chunks)} фрагментов")
     
-    # Убираем дубликаты (по source_id и approx_page)
-    unique_chunks = {}
-    for chunk in all_relevant_chunks:
-        key = (chunk['source_id'], chunk['approx_page'])
-        if key not in unique_chunks:
-            unique_chunks[key] = chunk
-    
-    # Формируем контекст для генерации
-    context_chunks = []
-    for chunk in list(unique_chunks.values())[:20]:  # Ограничиваем 20 ключевыми фрагментами
-        context_chunks.append(
-            f"[#{chunk['source_id']}, p.~{chunk['approx_page']}]: {chunk['text'][:400]}"
-        )
-    
-    context = "\n\n".join(context_chunks)
+    # Формируем контекст для генерации: фрагменты в порядке MMR (сходство с запросом
+    # с поправкой на повторы) в пределах бюджета токенов режима
+    context, context_tokens, _ = pack_context(all_relevant_chunks, "compact")
     print(len(context))
     
     # 2. Генерируем единый компактный обзор
@@ -156,7 +194,7 @@ def generate_compact_review(RESEARCH_TOPIC) -> Tuple[str, List[int], List[int]]:
 
 Начни обзор с краткого введения в проблематику:'''
     
-    review_text = call_deepseek(prompt, max_tokens=2500, temperature=1.5)
+    review_text = call_deepseek(prompt, max_tokens=2500, temperature=1.5, use_cache=False, on_delta=on_delta)
     
     # 3. Извлекаем использованные источники
     all_citations = extract_citations(review_text)
@@ -165,7 +203,7 @@ def generate_compact_review(RESEARCH_TOPIC) -> Tuple[str, List[int], List[int]]:
     
     # 4. Определяем неиспользованные источники
     try:
-        with open('relevant_texts.json', 'r', encoding='utf-8') as f:
+        with open(artifact_path(chat_id, 'relevant_texts.json'), 'r', encoding='utf-8') as f:
             all_relevant = json.load(f)
         all_relevant = {int(k): v for k, v in all_relevant.items()}
         all_relevant_ids = list(all_relevant.keys())
@@ -179,13 +217,15 @@ def generate_compact_review(RESEARCH_TOPIC) -> Tuple[str, List[int], List[int]]:
     
     print(f"\nСтатистика генерации:")
     print(f"- Длина обзора: {len(review_text)} символов (~{len(review_text.split())} слов)")
+    print(f"- Токенов контекста: {context_tokens}")
     print(f"- Использовано источников: {len(used_source_ids)}")
     print(f"- Не использовано: {len(unused_sources)}")
     
     return review_text, used_source_ids, unused_sources
 
 
-def generate_full_review(RESEARCH_TOPIC) -> Tuple[str, List[int], List[int]]:
+def generate_full_review(RESEARCH_TOPIC, chat_id: Optional[int] = None,
+                            on_delta: Optional[Callable[[str], None]] = None) -> Tuple[str, List[int], List[int]]:
     """
     Генерирует полный аналитический обзор без явных разделов.
     """
@@ -196,37 +236,16 @@ def generate_full_review(RESEARCH_TOPIC) -> Tuple[str, List[int], List[int]]:
     # 1. Сначала собираем ключевую информацию из источников
     print("\n[Шаг 1] Сбор ключевой информации из источников...")
     
-    # Ищем информацию по ключевым аспектам
-    search_queries = [
-        "теория концепция подход",
-        "методология исследование метод",
-        "дискуссия противоречие разногласие",
-        "хронология развитие история эволюция темы",
-        "результат вывод исследование",
-        "пробел ограничение"
-    ]
-    
+    # Ищем информацию по ключевым аспектам одним пакетным запросом
     all_relevant_chunks = []
-    for query in search_queries:
-        chunks = search_in_vector_db(query, n_results=4)
+    results = search_many_in_vector_db(SEARCH_QUERIES, n_results=4, chat_id=chat_id, include_embeddings=True)
+    for query, chunks in zip(SEARCH_QUERIES, results):
         all_relevant_chunks.extend(chunks)
         print(f"  Поиск '{query}': найдено {len(chunks)} фрагментов")
     
-    # Убираем дубликаты (по source_id и approx_page)
-    unique_chunks = {}
-    for chunk in all_relevant_chunks:
-        key = (chunk['source_id'], chunk['approx_page'])
-        if key not in unique_chunks:
-            unique_chunks[key] = chunk
-    
-    # Формируем контекст для генерации
-    context_chunks = []
-    for chunk in list(unique_chunks.values())[:20]:  # Ограничиваем 20 ключевыми фрагментами
-        context_chunks.append(
-            f"[#{chunk['source_id']}, p.~{chunk['approx_page']}]: {chunk['text'][:400]}"
-        )
-    
-    context = "\n\n".join(context_chunks)
+    # Формируем контекст для генерации: фрагменты в порядке MMR (сходство с запросом
+    # с поправкой на повторы) в пределах бюджета токенов режима
+    context, context_tokens, _ = pack_context(all_relevant_chunks, "full")
     
     # 2. Генерируем единый компактный обзор
     print("\n[Шаг 2] Генерация единого аналитического обзора...")
@@ -257,7 +276,7 @@ def generate_full_review(RESEARCH_TOPIC) -> Tuple[str, List[int], List[int]]:
 
 Начни обзор с краткого введения в проблематику:'''
     
-    review_text = call_deepseek(prompt, max_tokens=2500, temperature=1.5)
+    review_text = call_deepseek(prompt, max_tokens=2500, temperature=1.5, use_cache=False, on_delta=on_delta)
     
     # 3. Извлекаем использованные источники
     all_citations = extract_citations(review_text)
@@ -266,7 +285,7 @@ def generate_full_review(RESEARCH_TOPIC) -> Tuple[str, List[int], List[int]]:
     
     # 4. Определяем неиспользованные источники
     try:
-        with open('relevant_texts.json', 'r', encoding='utf-8') as f:
+        with open(artifact_path(chat_id, 'relevant_texts.json'), 'r', encoding='utf-8') as f:
             all_relevant = json.load(f)
         all_relevant = {int(k): v for k, v in all_relevant.items()}
         all_relevant_ids = list(all_relevant.keys())
@@ -280,12 +299,14 @@ def generate_full_review(RESEARCH_TOPIC) -> Tuple[str, List[int], List[int]]:
     
     print(f"\nСтатистика генерации:")
     print(f"- Длина обзора: {len(review_text)} символов (~{len(review_text.split())} слов)")
+    print(f"- Токенов контекста: {context_tokens}")
     print(f"- Использовано источников: {len(used_source_ids)}")
     print(f"- Не использовано: {len(unused_sources)}")
     
     return review_text, used_source_ids, unused_sources
 
-def save_results(review_text: str, used_sources: List[int], unused_sources: List[int]):
+def save_results(review_text: str, used_sources: List[int], unused_sources: List[int],
+                 chat_id: Optional[int] = None):
     """
     Сохраняет обзор и информацию.
     """
@@ -294,7 +315,7 @@ def save_results(review_text: str, used_sources: List[int], unused_sources: List
     print("=" * 50)
     
     # 1. Сохраняем компактный обзор
-    review_filename = "literature_review.txt"
+    review_filename = artifact_path(chat_id, "literature_review.txt")
     
     # Добавляем заголовок и статистику
     word_count = len(review_text.split())
@@ -309,25 +330,27 @@ def save_results(review_text: str, used_sources: List[int], unused_sources: List
     print(f"Объем: ~{word_count} слов")
 
 
-def initital_generating(RESEARCH_TOPIC, mode):
+def initital_generating(RESEARCH_TOPIC, mode, chat_id: Optional[int] = None,
+                        on_delta: Optional[Callable[[str], None]] = None):
     """
     Главная функция для генерации компактного обзора.
+    on_delta получает фрагменты текста обзора по мере генерации (потоковый режим).
     """
     print("Запуск генерации КОМПАКТНОГО\ПОЛНОГО литературного обзора")
     print(f"Тема: {RESEARCH_TOPIC}")
     
     # Генерация обзоров по режимам
     if mode != 'full':
-        review_text, used_sources, unused_sources = generate_compact_review(RESEARCH_TOPIC)
+        review_text, used_sources, unused_sources = generate_compact_review(RESEARCH_TOPIC, chat_id, on_delta)
     else:
-        used_sources, unused_sources, review_text = generate_full_review(RESEARCH_TOPIC)
+        review_text, used_sources, unused_sources = generate_full_review(RESEARCH_TOPIC, chat_id, on_delta)
     
     if not review_text or len(review_text) < 300:
         print("\nОШИБКА: не удалось сгенерировать обзор!")
         return
     
     # Сохранение результатов
-    save_results(review_text, used_sources, unused_sources)
+    save_results(review_text, used_sources, unused_sources, chat_id)
     
     print("\n" + "=" * 50)
     print("ГЕНЕРАЦИЯ ОБЗОРА ЗАВЕРШЕНА!")
@@ -338,9 +361,11 @@ def initital_generating(RESEARCH_TOPIC, mode):
 def rewrite_review_with_instruction(original_review: str, 
                                 
                                    user_instruction: str,
+                                   on_delta: Optional[Callable[[str], None]] = None
                                    ) -> str:
     """
     Переписывает существующий обзор по новой инструкции пользователя.
+    on_delta получает фрагменты нового текста по мере генерации (потоковый режим).
     """
     print("\n" + "=" * 50)
     print("ПЕРЕПИСЫВАНИЕ ОБЗОРА ПО ИНСТРУКЦИИ")
@@ -368,6 +393,7 @@ def rewrite_review_with_instruction(original_review: str,
 
 ПЕРЕРАБОТАННЫЙ ОБЗОР:'''
     
-    new_review = call_deepseek(rewrite_prompt, max_tokens=2000)
+    new_review = call_deepseek(rewrite_prompt, max_tokens=2000, use_cache=False, on_delta=on_delta,
+                               budget=REWRITE_LLM_BUDGET)
     
     return new_review
\ No newline at end of file
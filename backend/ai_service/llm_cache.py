@@ -0,0 +1,122 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, Optional
+
+BASE_DIR = Path(__file__).parent.parent  # поднимаемся из ai_service в backend
+LLM_CACHE_PATH = BASE_DIR / "cache" / "llm_responses.db"
+LLM_CACHE_TTL = 7 * 24 * 3600  # секунд жизни ответа в кэше
+LLM_CACHE_MAX_ENTRIES = 50000  # максимум ответов в кэше
+
+
+class LLMResponseCache:
+    """
+    Дисковый кэш ответов LLM в SQLite.
+    Ключ - модель, хэш промпта и параметры генерации (temperature, max_tokens и т.п.).
+    Записи старше ttl считаются промахом, при превышении max_entries удаляются
+    записи, к которым дольше всего не обращались.
+    """
+
+    def __init__(self, db_path: Path, ttl: float = LLM_CACHE_TTL, max_entries: int = LLM_CACHE_MAX_ENTRIES):
+        self.db_path = Path(db_path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stats = {"hits": 0, "misses": 0, "writes": 0, "evicted": 0}
+        self._lock = threading.Lock()
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses (accessed_at)")
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # Отдельное соединение на операцию: кэш используется из разных потоков
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def make_key(model: str, prompt: str, **params) -> str:
+        """Ключ кэша: модель + SHA-256 промпта + параметры генерации."""
+        prompt_hash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        payload = json.dumps({"model": model, "prompt": prompt_hash, "params": params}, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, model: str, prompt: str, **params) -> Optional[str]:
+        """Возвращает сохраненный ответ или None при промахе."""
+        key = self.make_key(model, prompt, **params)
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT content, created_at FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and now - row[1] > self.ttl:
+                    conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    row = None
+                if row is not None:
+                    conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+        except sqlite3.Error as e:
+            print(f"Ошибка чтения кэша LLM: {e}")
+            row = None
+
+        with self._lock:
+            self.stats["hits" if row is not None else "misses"] += 1
+        return row[0] if row is not None else None
+
+    def put(self, model: str, prompt: str, content: str, **params) -> None:
+        """Сохраняет ответ. Пустые ответы (ошибки) не кэшируются."""
+        if not content:
+            return
+        key = self.make_key(model, prompt, **params)
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, model, content, created_at, accessed_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (key, model, content, now, now)
+                )
+                evicted = self._evict(conn, now)
+        except sqlite3.Error as e:
+            print(f"Ошибка записи кэша LLM: {e}")
+            return
+
+        with self._lock:
+            self.stats["writes"] += 1
+            self.stats["evicted"] += evicted
+
+    def _evict(self, conn: sqlite3.Connection, now: float) -> int:
+        """Удаляет просроченные записи и самые давние по обращению сверх max_entries."""
+        removed = conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,)).rowcount
+        count = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        if count > self.max_entries:
+            removed += conn.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY accessed_at LIMIT ?)",
+                (count - self.max_entries,)
+            ).rowcount
+        return removed
+
+    def get_stats(self) -> Dict[str, int]:
+        """Счетчики попаданий и промахов с момента запуска процесса."""
+        with self._lock:
+            return dict(self.stats)
+
+
+response_cache = LLMResponseCache(LLM_CACHE_PATH)
@@ -0,0 +1,288 @@
+import asyncio
+import random
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+import httpx
+import openai
+from openai import AsyncOpenAI, OpenAI
+
+import config as cn
+from ai_service.llm_cache import response_cache
+
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+LLM_MODEL = "deepseek/deepseek-v3.2"
+
+LLM_MAX_CONNECTIONS = 20  # соединений в пуле HTTP-клиента
+LLM_RATE_LIMIT = 5.0  # запросов в секунду (по квоте OpenRouter)
+LLM_RATE_BURST = 10  # сколько запросов можно отправить разом после простоя
+LLM_MAX_RETRIES = 5  # повторов при 429/5xx и сетевых ошибках
+LLM_BACKOFF_BASE = 1.0  # секунд до первого повтора, дальше удваивается
+LLM_BACKOFF_MAX = 30.0  # максимальная пауза между повторами, секунд
+LLM_REQUEST_TIMEOUT = 120.0  # таймаут HTTP-запроса, секунд
+
+
+_stats = {"requests": 0, "retries": 0, "throttled": 0, "throttle_wait": 0.0, "failures": 0}
+_stats_lock = threading.Lock()
+
+
+def _count(name: str, wait: float = 0.0) -> None:
+    with _stats_lock:
+        _stats[name] += 1
+        if name == "throttled":
+            _stats["throttle_wait"] += wait
+
+
+def get_stats() -> Dict[str, float]:
+    """Счетчики запросов, повторов и ожиданий ограничителя с момента запуска процесса."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+class TokenBucket:
+    """
+    Ограничитель частоты запросов "token bucket", общий для всех потоков процесса.
+    Токены пополняются со скоростью rate в секунду, не больше capacity.
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """Забирает токен и возвращает, сколько секунд нужно подождать до его появления."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self) -> float:
+        wait = self._reserve()
+        if wait > 0:
+            _count("throttled", wait)
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self) -> float:
+        wait = self._reserve()
+        if wait > 0:
+            _count("throttled", wait)
+            await asyncio.sleep(wait)
+        return wait
+
+
+rate_limiter = TokenBucket(LLM_RATE_LIMIT, LLM_RATE_BURST)
+
+client = OpenAI(
+    api_key=cn.DEEPSEEK_API_KEY,
+    base_url=OPENROUTER_BASE_URL,
+    max_retries=0,  # повторы делаем сами, с учетом ограничителя частоты
+    http_client=httpx.Client(
+        limits=httpx.Limits(max_connections=LLM_MAX_CONNECTIONS,
+                            max_keepalive_connections=LLM_MAX_CONNECTIONS),
+        timeout=LLM_REQUEST_TIMEOUT
+    )
+)
+
+
+def create_async_client() -> AsyncOpenAI:
+    """
+    Асинхронный клиент с теми же настройками пула соединений и без встроенных повторов.
+    Соединения asyncio привязаны к циклу событий, поэтому клиент создается
+    на каждый asyncio.run и закрывается через async with.
+    """
+    return AsyncOpenAI(
+        api_key=cn.DEEPSEEK_API_KEY,
+        base_url=OPENROUTER_BASE_URL,
+        max_retries=0,
+        http_client=httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=LLM_MAX_CONNECTIONS,
+                                max_keepalive_connections=LLM_MAX_CONNECTIONS),
+            timeout=LLM_REQUEST_TIMEOUT
+        )
+    )
+
+
+def is_retryable(error: Exception) -> bool:
+    """429, 5xx, таймауты и сетевые ошибки стоит повторить, остальные - нет."""
+    if isinstance(error, (openai.RateLimitError, openai.APIConnectionError, asyncio.TimeoutError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return False
+
+
+def backoff_delay(attempt: int) -> float:
+    """Экспоненциальная пауза с полным джиттером (attempt начинается с 0)."""
+    return random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))
+
+
+class LLMDeadlineExceeded(TimeoutError):
+    """Общий срок запроса (вместе с повторами) истек."""
+
+
+def time_left(deadline: Optional[float]) -> Optional[float]:
+    """
+    Сколько секунд осталось до deadline (момент по time.monotonic(); None - без срока).
+    Если срок уже истек, выбрасывает LLMDeadlineExceeded.
+    """
+    if deadline is None:
+        return None
+    left = deadline - time.monotonic()
+    if left <= 0:
+        _count("failures")
+        raise LLMDeadlineExceeded("Срок запроса к LLM истек")
+    return left
+
+
+def attempt_timeout(timeout: Optional[float], deadline: Optional[float]) -> Optional[float]:
+    """Таймаут очередной попытки: не больше timeout и не дальше deadline."""
+    left = time_left(deadline)
+    if left is None:
+        return timeout
+    return left if timeout is None else min(timeout, left)
+
+
+def can_retry(delay: float, deadline: Optional[float]) -> bool:
+    """Хватает ли времени до deadline на паузу перед повтором."""
+    return deadline is None or time.monotonic() + delay < deadline
+
+
+def chat_completion(prompt: str, max_tokens: int, temperature: float = 1.0,
+                    use_cache: bool = True, model: str = LLM_MODEL,
+                    deadline: Optional[float] = None) -> str:
+    """
+    Запрос к LLM через общий клиент: кэш ответов, ограничитель частоты и повторы
+    с экспоненциальной паузой. Если все попытки неудачны, ошибка пробрасывается.
+    deadline (момент по time.monotonic()) ограничивает запрос вместе со всеми повторами.
+    """
+    params = {"temperature": temperature, "max_tokens": max_tokens}
+    if use_cache:
+        cached = response_cache.get(model, prompt, **params)
+        if cached is not None:
+            return cached
+
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        rate_limiter.acquire()
+        request_timeout = attempt_timeout(LLM_REQUEST_TIMEOUT, deadline)
+        _count("requests")
+        try:
+            response = client.chat.completions.create(
+                model=model,
+                messages=[{"role": "user", "content": prompt}],
+                timeout=request_timeout,
+                **params
+            )
+            break
+        except Exception as e:
+            delay = backoff_delay(attempt)
+            if attempt == LLM_MAX_RETRIES or not is_retryable(e) or not can_retry(delay, deadline):
+                _count("failures")
+                raise
+            _count("retries")
+            print(f"Ошибка запроса к LLM ({e!r}), повтор через {delay:.1f} с")
+            time.sleep(delay)
+
+    content = response.choices[0].message.content.strip()
+    if use_cache:
+        response_cache.put(model, prompt, content, **params)
+    return content
+
+
+def chat_completion_stream(prompt: str, on_delta: Callable[[str], None], max_tokens: int,
+                           temperature: float = 1.0, use_cache: bool = True, model: str = LLM_MODEL,
+                           deadline: Optional[float] = None) -> str:
+    """
+    Потоковая версия chat_completion (stream=True): фрагменты ответа передаются
+    в on_delta по мере генерации, возвращается полный текст. Повтор делается,
+    только пока не пришел первый фрагмент, иначе текст дошел бы до клиента дважды.
+    Ответ из кэша передается в on_delta целиком. deadline - как в chat_completion.
+    """
+    params = {"temperature": temperature, "max_tokens": max_tokens}
+    if use_cache:
+        cached = response_cache.get(model, prompt, **params)
+        if cached is not None:
+            on_delta(cached)
+            return cached
+
+    parts = []
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        rate_limiter.acquire()
+        request_timeout = attempt_timeout(LLM_REQUEST_TIMEOUT, deadline)
+        _count("requests")
+        try:
+            stream = client.chat.completions.create(
+                model=model,
+                messages=[{"role": "user", "content": prompt}],
+                stream=True,
+                timeout=request_timeout,
+                **params
+            )
+            for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    parts.append(delta)
+                    on_delta(delta)
+            break
+        except Exception as e:
+            delay = backoff_delay(attempt)
+            if parts or attempt == LLM_MAX_RETRIES or not is_retryable(e) or not can_retry(delay, deadline):
+                _count("failures")
+                raise
+            _count("retries")
+            print(f"Ошибка запроса к LLM ({e!r}), повтор через {delay:.1f} с")
+            time.sleep(delay)
+
+    content = "".join(parts).strip()
+    if use_cache:
+        response_cache.put(model, prompt, content, **params)
+    return content
+
+
+async def chat_completion_async(async_client: AsyncOpenAI, prompt: str, max_tokens: int,
+                                temperature: float = 1.0, timeout: Optional[float] = None,
+                                use_cache: bool = True, model: str = LLM_MODEL,
+                                deadline: Optional[float] = None) -> str:
+    """
+    Асинхронная версия chat_completion; timeout ограничивает каждую попытку,
+    deadline (момент по time.monotonic()) - запрос вместе со всеми повторами.
+    """
+    params = {"temperature": temperature, "max_tokens": max_tokens}
+    if use_cache:
+        cached = response_cache.get(model, prompt, **params)
+        if cached is not None:
+            return cached
+
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        await rate_limiter.acquire_async()
+        request_timeout = attempt_timeout(timeout, deadline)
+        _count("requests")
+        try:
+            response = await asyncio.wait_for(
+                async_client.chat.completions.create(
+                    model=model,
+                    messages=[{"role": "user", "content": prompt}],
+                    **params
+                ),
+                timeout=request_timeout
+            )
+            break
+        except Exception as e:
+            delay = backoff_delay(attempt)
+            if attempt == LLM_MAX_RETRIES or not is_retryable(e) or not can_retry(delay, deadline):
+                _count("failures")
+                raise
+            _count("retries")
+            print(f"Ошибка запроса к LLM ({e!r}), повтор через {delay:.1f} с")
+            await asyncio.sleep(delay)
+
+    content = response.choices[0].message.content.strip()
+    if use_cache:
+        response_cache.put(model, prompt, content, **params)
+    return content
@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import List, Optional
+
+HASH_BLOCK_SIZE = 1024 * 1024  # читаем файл блоками по 1 МБ
+
+
+def file_sha256(path: str) -> str:
+    """Считает SHA-256 содержимого файла."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class PdfTextCache:
+    """
+    Персистентный кэш извлеченного из PDF постраничного текста.
+    Ключ - SHA-256 байтов PDF, поэтому один и тот же файл, загруженный
+    в разные чаты под разными uuid-именами, извлекается только один раз.
+    Общий размер ограничен max_bytes, при переполнении удаляются записи,
+    к которым дольше всего не обращались (LRU по времени модификации файла).
+    """
+
+    def __init__(self, cache_dir: Path, max_bytes: int):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.remove_legacy_entries()
+
+    def _path(self, digest: str) -> Path:
+        return self.cache_dir / f"{digest}.json"
+
+    def remove_legacy_entries(self) -> int:
+        """
+        Удаляет записи старого формата {digest}.txt (весь текст одной строкой).
+        Границ страниц в них нет, поэтому перевести их в постраничный формат нельзя,
+        а get и evict их не видят. Возвращает число удаленных.
+        """
+        removed = 0
+        for path in self.cache_dir.glob("*.txt"):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                print(f"Ошибка удаления {path}: {e}")
+                continue
+            removed += 1
+        if removed:
+            print(f"Кэш текстов PDF: удалено {removed} записей старого формата")
+        return removed
+
+    def get(self, digest: str) -> Optional[List[str]]:
+        """Возвращает список текстов страниц из кэша или None, если записи нет."""
+        path = self._path(digest)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                pages = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Ошибка чтения кэша {path}: {e}")
+            return None
+        # Отмечаем обращение для LRU
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return pages
+
+    def put(self, digest: str, pages: List[str]) -> None:
+        """Сохраняет тексты страниц в кэш и при необходимости вытесняет старые записи."""
+        path = self._path(digest)
+        tmp_path = None
+        try:
+            # Уникальный временный файл: один и тот же PDF могут одновременно сохранять несколько чатов
+            with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=self.cache_dir, prefix=f"{digest}.",
+                                             suffix=".tmp", delete=False) as f:
+                tmp_path = Path(f.name)
+                json.dump(pages, f, ensure_ascii=False)
+            # Атомарная замена, чтобы параллельные чаты не читали недописанный файл
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"Ошибка записи кэша {path}: {e}")
+            if tmp_path is not None and tmp_path.exists():
+                tmp_path.unlink()
+            return
+        self.evict()
+
+    def evict(self) -> int:
+        """Удаляет самые старые записи, пока кэш не уложится в max_bytes. Возвращает число удаленных."""
+        entries = []
+        total = 0
+        for path in self.cache_dir.glob("*.json"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        removed = 0
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+
+        if removed:
+            print(f"Кэш текстов PDF: вытеснено {removed} записей")
+        return removed
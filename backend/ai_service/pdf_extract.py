@@ -0,0 +1,61 @@
+from typing import Iterator, List, Tuple
+
+import PyPDF2
+
+# Функции этого модуля выполняются в процессах пула извлечения текста (collect_files.get_pdf_pool),
+# поэтому он не должен импортировать ничего, кроме PyPDF2: каждый процесс импортирует его заново.
+
+SAMPLE_HEAD_PAGES = 2  # страниц из начала документа для выборки
+SAMPLE_TAIL_PAGES = 2  # страниц из конца документа для выборки
+
+
+def iter_pdf_pages(pdf_path: str) -> Iterator[Tuple[int, str]]:
+    """
+    Постранично извлекает текст из PDF файла.
+    Отдает пары (номер_страницы, текст) по одной, номера страниц начинаются с 1.
+    Ошибка чтения пробрасывается вызывающему после уже отданных страниц.
+    """
+    with open(pdf_path, 'rb') as file:
+        reader = PyPDF2.PdfReader(file)
+        for page_num, page in enumerate(reader.pages, start=1):
+            yield page_num, page.extract_text() or ""
+
+def extract_pages_from_pdf(pdf_path: str) -> Tuple[List[str], bool]:
+    """
+    Извлекает текст всех страниц PDF. Элемент i списка - страница i + 1.
+    Возвращает (тексты_страниц, полностью). При ошибке посреди документа
+    возвращаются страницы, прочитанные до нее, и False.
+    """
+    pages = []
+    try:
+        for _, page_text in iter_pdf_pages(pdf_path):
+            pages.append(page_text)
+    except Exception as e:
+        print(f"Ошибка чтения {pdf_path} (прочитано страниц: {len(pages)}): {e}")
+        return pages, False
+    return pages, True
+
+def extract_sample_pages(pdf_path: str) -> Tuple[List[str], bool]:
+    """
+    Извлекает только страницы, нужные для выборки get_smart_text_sample:
+    несколько первых, одну из середины и несколько последних.
+    Возвращает (тексты_страниц, полностью), как extract_pages_from_pdf.
+    """
+    pages = []
+    try:
+        with open(pdf_path, 'rb') as file:
+            reader = PyPDF2.PdfReader(file)
+            num_pages = len(reader.pages)
+            head = range(min(SAMPLE_HEAD_PAGES, num_pages))
+            tail = range(max(num_pages - SAMPLE_TAIL_PAGES, 0), num_pages)
+            page_indexes = sorted(set(head) | {num_pages // 2} | set(tail)) if num_pages else []
+            for page_idx in page_indexes:
+                pages.append(reader.pages[page_idx].extract_text() or "")
+    except Exception as e:
+        print(f"Ошибка чтения {pdf_path}: {e}")
+        return pages, False
+    return pages, True
+
+def pages_to_text(pages: List[str]) -> str:
+    """Склеивает страницы в один текст (пустые страницы пропускаются)."""
+    return "".join(page_text + "\n" for page_text in pages if page_text)
@@ -0,0 +1,597 @@
+import json
+import os
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from ai_service.chat_workspace import artifact_path, collection_name, get_chroma_client
+
+VECTOR_BACKEND = "auto"  # "numpy", "chroma" или "auto" - выбор по размеру коллекции
+NUMPY_MAX_CHUNKS = 20000  # до скольких чанков в режиме auto используется точный поиск NumPy
+CHROMA_BATCH_SIZE = 100  # ограничение ChromaDB на размер батча
+VECTOR_PRECISION = "float32"  # хранение векторов в NumPy-индексе: "float32", "float16" или "int8"
+RESCORE_FACTOR = 4  # во сколько раз больше кандидатов int8-индекса пересчитывать по float16-векторам
+SCORE_BLOCK_ROWS = 4096  # строк компактной матрицы, переводимых в float32 за раз
+# Параметры HNSW-индекса коллекций ChromaDB (значения по умолчанию библиотеки);
+# подбираются бенчмарком benchmarks.bench_hnsw
+HNSW_M = 16  # связей у вершины графа: больше - точнее поиск, но больше памяти и дольше построение
+HNSW_CONSTRUCTION_EF = 100  # ширина поиска соседей при построении
+HNSW_SEARCH_EF = 100  # ширина поиска при запросе (задается при создании коллекции)
+LOADED_NUMPY_STORES_MAX = 16  # NumPy-индексов чатов, которые держатся в памяти между поисками (LRU)
+
+BACKEND_NUMPY = "numpy"
+BACKEND_CHROMA = "chroma"
+
+PRECISION_FLOAT32 = "float32"
+PRECISION_FLOAT16 = "float16"
+PRECISION_INT8 = "int8"
+PRECISIONS = {PRECISION_FLOAT32: np.float32, PRECISION_FLOAT16: np.float16, PRECISION_INT8: np.int8}
+
+RESCORE_DTYPE = np.float16  # векторы для пересчета кандидатов int8-индекса
+
+_numpy_io_lock = threading.Lock()  # файлы индекса пишутся и читаются согласованно
+
+
+def choose_backend(num_chunks: int, backend: Optional[str] = None) -> str:
+    """Бэкенд для коллекции из num_chunks чанков (по умолчанию - по VECTOR_BACKEND)."""
+    backend = backend or VECTOR_BACKEND
+    if backend != "auto":
+        return backend
+    return BACKEND_NUMPY if num_chunks <= NUMPY_MAX_CHUNKS else BACKEND_CHROMA
+
+
+def hnsw_metadata(m: Optional[int] = None, construction_ef: Optional[int] = None,
+                  search_ef: Optional[int] = None) -> Dict:
+    """Метаданные коллекции ChromaDB с параметрами HNSW (по умолчанию - из HNSW_*)."""
+    return {
+        "hnsw:space": "cosine",  # используем косинусное расстояние
+        "hnsw:M": m or HNSW_M,
+        "hnsw:construction_ef": construction_ef or HNSW_CONSTRUCTION_EF,
+        "hnsw:search_ef": search_ef or HNSW_SEARCH_EF
+    }
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """Нормирует строки матрицы (косинусное сходство = скалярное произведение)."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class VectorStore(ABC):
+    """
+    Интерфейс векторного индекса чата, общий для индексации (vectorizing.py)
+    и поиска (generating.py). Чанки идентифицируются строковым id, в метаданных
+    чанка хранится doc_hash - ключ документа, по которому идет инкрементальное обновление.
+    """
+
+    backend = ""
+    precision = PRECISION_FLOAT32
+
+    @abstractmethod
+    def count(self) -> int:
+        ...
+
+    @abstractmethod
+    def get_indexed_documents(self) -> Optional[Dict[str, Dict]]:
+        """
+        {ключ_документа: {"source_id": ..., "ids": [...], "metadatas": [...]}}
+        или None, если в индексе есть чанки без ключа (база старого формата).
+        """
+
+    @abstractmethod
+    def get_chunks(self, ids: Optional[List[str]] = None) -> Dict[str, Tuple[str, Dict]]:
+        """{id_чанка: (текст, метаданные)} для чанков ids (по умолчанию - всех чанков индекса)."""
+
+    @abstractmethod
+    def upsert(self, ids: List[str], embeddings: np.ndarray, documents: List[str], metadatas: List[Dict]) -> None:
+        ...
+
+    @abstractmethod
+    def update_metadatas(self, ids: List[str], metadatas: List[Dict]) -> None:
+        ...
+
+    @abstractmethod
+    def delete_documents(self, doc_hashes: List[str]) -> None:
+        ...
+
+    @abstractmethod
+    def query(self, query_embeddings: np.ndarray, n_results: int,
+              include_embeddings: bool = False) -> List[List[Dict]]:
+        """
+        Для каждого запроса - до n_results ближайших чанков по убыванию сходства:
+        {"id", "text", "metadata", "similarity"}; с include_embeddings еще и
+        "embedding" - нормированный float32-вектор чанка.
+        """
+
+    def save(self) -> None:
+        """Сбрасывает изменения на диск (если бэкенд не делает этого сам)."""
+
+    @abstractmethod
+    def drop(self) -> None:
+        """Удаляет индекс целиком."""
+
+
+def group_by_document(ids: List[str], metadatas: List[Dict]) -> Optional[Dict[str, Dict]]:
+    """Группирует чанки по ключу документа (см. VectorStore.get_indexed_documents)."""
+    documents = {}
+    for chunk_id, metadata in zip(ids, metadatas):
+        doc_hash = (metadata or {}).get("doc_hash")
+        if not doc_hash:
+            return None
+        entry = documents.setdefault(doc_hash, {"source_id": metadata.get("source_id"), "ids": [], "metadatas": []})
+        entry["ids"].append(chunk_id)
+        entry["metadatas"].append(metadata)
+    return documents
+
+
+class NumpyVectorStore(VectorStore):
+    """
+    Точный поиск в памяти для небольших коллекций (сотни - тысячи чанков).
+    Нормированные эмбеддинги хранятся непрерывной матрицей в одном .npy файле,
+    тексты и метаданные - рядом в .json. Поиск - одно матричное умножение на все
+    запросы сразу и argpartition для top-k, без HNSW, SQLite и батчей по 100.
+    
+    Матрица хранится в точности precision:
+    - float32 - как есть
+    - float16 - в 2 раза компактнее
+    - int8 - скалярное квантование с масштабом на вектор, в 4 раза компактнее
+    Для int8 кандидаты (RESCORE_FACTOR * k) отбираются по int8-матрице, а затем
+    пересчитываются по float16-копии векторов из файла .rescore.npy того же чата.
+    Загруженный индекс отображает этот файл в память (np.load с mmap_mode) и читает
+    только строки кандидатов, поэтому в памяти процесса остается int8-матрица.
+    На диске int8-индекс вместе с копией занимает ~3 байта на измерение - больше float16.
+    """
+
+    backend = BACKEND_NUMPY
+
+    def __init__(self, path: Path, precision: str = PRECISION_FLOAT32):
+        if precision not in PRECISIONS:
+            raise ValueError(f"Неизвестная точность векторов: {precision}")
+        self.path = Path(path)
+        self.meta_path = self.path.with_suffix(".json")
+        self.rescore_path = self.path.with_suffix(".rescore.npy")
+        self.precision = precision
+        self.vectors = np.zeros((0, 0), dtype=PRECISIONS[precision])
+        self.scales = np.zeros(0, dtype=np.float32)  # масштабы строк для int8
+        # float16-векторы строк для пересчета кандидатов (только для int8, иначе None)
+        self.rescore_vectors: Optional[np.ndarray] = None
+        self.ids: List[str] = []
+        self.documents: List[str] = []
+        self.metadatas: List[Dict] = []
+
+    @classmethod
+    def load(cls, path: Path, mmap_rescore: bool = True) -> "NumpyVectorStore":
+        """
+        Загружает индекс. С mmap_rescore=True векторы для пересчета отображаются
+        в память только для чтения, для изменения индекса они читаются целиком.
+        """
+        with _numpy_io_lock:
+            return cls._load_locked(path, mmap_rescore)
+
+    @classmethod
+    def _load_locked(cls, path: Path, mmap_rescore: bool = True) -> "NumpyVectorStore":
+        """load без блокировки - для вызова под _numpy_io_lock."""
+        vectors = np.load(path)
+        with open(Path(path).with_suffix(".json"), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        store = cls(path, meta.get("precision", PRECISION_FLOAT32))
+        if store.precision == PRECISION_INT8 and store.rescore_path.exists():
+            store.rescore_vectors = np.load(store.rescore_path, mmap_mode='r' if mmap_rescore else None)
+        store.vectors = vectors
+        # Масштабы сохраняются только для int8, для остальных точностей - нули по числу строк
+        store.scales = np.asarray(meta.get("scales", np.zeros(len(vectors))), dtype=np.float32)
+        store.ids, store.documents, store.metadatas = meta["ids"], meta["documents"], meta["metadatas"]
+        return store
+
+    def count(self) -> int:
+        return len(self.ids)
+
+    def can_rescore(self) -> bool:
+        """Есть ли векторы для пересчета кандидатов (нет у int8-индексов старого формата)."""
+        return self.rescore_vectors is not None and len(self.rescore_vectors) == len(self.ids)
+
+    def nbytes(self) -> int:
+        """Объем векторов в памяти процесса, байт (файл для пересчета только отображается в память)."""
+        return self.vectors.nbytes + self.scales.nbytes
+
+    def disk_bytes(self) -> Dict[str, int]:
+        """Размеры сохраненных файлов индекса, байт: {"vectors", "rescore", "meta"}."""
+        paths = {"vectors": self.path, "rescore": self.rescore_path, "meta": self.meta_path}
+        return {name: path.stat().st_size if path.exists() else 0 for name, path in paths.items()}
+
+    def get_indexed_documents(self) -> Optional[Dict[str, Dict]]:
+        return group_by_document(self.ids, self.metadatas)
+
+    def get_chunks(self, ids: Optional[List[str]] = None) -> Dict[str, Tuple[str, Dict]]:
+        wanted = None if ids is None else set(ids)
+        return {chunk_id: (document, metadata)
+                for chunk_id, document, metadata in zip(self.ids, self.documents, self.metadatas)
+                if wanted is None or chunk_id in wanted}
+
+    def _compress(self, embeddings: np.ndarray):
+        """Нормированные векторы -> (строки матрицы в точности precision, масштабы строк)."""
+        if self.precision == PRECISION_INT8:
+            scales = np.maximum(np.abs(embeddings).max(axis=1), 1e-12) / 127
+            codes = np.clip(np.rint(embeddings / scales[:, None]), -127, 127).astype(np.int8)
+            return codes, scales.astype(np.float32)
+        return embeddings.astype(PRECISIONS[self.precision]), np.zeros(len(embeddings), dtype=np.float32)
+
+    def upsert(self, ids: List[str], embeddings: np.ndarray, documents: List[str], metadatas: List[Dict]) -> None:
+        embeddings = normalize(embeddings)
+        rows, scales = self._compress(embeddings)
+        rescore = embeddings.astype(RESCORE_DTYPE) if self.precision == PRECISION_INT8 else None
+        if not self.ids:
+            self.vectors = np.zeros((0, rows.shape[1]), dtype=rows.dtype)
+            self.scales = np.zeros(0, dtype=np.float32)
+            self.rescore_vectors = None if rescore is None else np.zeros((0, rows.shape[1]), dtype=RESCORE_DTYPE)
+        elif rescore is not None and not self.can_rescore():
+            raise ValueError("В int8-индексе нет векторов для пересчета, индекс нужно перестроить")
+        positions = {chunk_id: i for i, chunk_id in enumerate(self.ids)}
+        new_rows = []
+        for i, chunk_id in enumerate(ids):
+            row = positions.get(chunk_id)
+            if row is None:
+                new_rows.append(i)
+                continue
+            self.vectors[row] = rows[i]
+            self.scales[row] = scales[i]
+            if rescore is not None:
+                self.rescore_vectors[row] = rescore[i]
+            self.documents[row] = documents[i]
+            self.metadatas[row] = metadatas[i]
+        if new_rows:
+            self.vectors = np.concatenate([self.vectors, rows[new_rows]])
+            self.scales = np.concatenate([self.scales, scales[new_rows]])
+            if rescore is not None:
+                self.rescore_vectors = np.concatenate([self.rescore_vectors, rescore[new_rows]])
+            self.ids.extend(ids[i] for i in new_rows)
+            self.documents.extend(documents[i] for i in new_rows)
+            self.metadatas.extend(metadatas[i] for i in new_rows)
+
+    def update_metadatas(self, ids: List[str], metadatas: List[Dict]) -> None:
+        positions = {chunk_id: i for i, chunk_id in enumerate(self.ids)}
+        for chunk_id, metadata in zip(ids, metadatas):
+            if chunk_id in positions:
+                self.metadatas[positions[chunk_id]] = metadata
+
+    def delete_documents(self, doc_hashes: List[str]) -> None:
+        doc_hashes = set(doc_hashes)
+        keep = [i for i, metadata in enumerate(self.metadatas) if metadata.get("doc_hash") not in doc_hashes]
+        if len(keep) == len(self.ids):
+            return
+        self.vectors = self.vectors[keep]
+        self.scales = self.scales[keep]
+        if self.rescore_vectors is not None:
+            self.rescore_vectors = self.rescore_vectors[keep]
+        self.ids = [self.ids[i] for i in keep]
+        self.documents = [self.documents[i] for i in keep]
+        self.metadatas = [self.metadatas[i] for i in keep]
+
+    def _scores(self, queries: np.ndarray) -> np.ndarray:
+        """Сходство запросов со всеми чанками по хранимой матрице, (запросы, чанки) float32."""
+        if self.precision == PRECISION_FLOAT32:
+            return queries @ self.vectors.T
+        # Компактная матрица переводится в float32 блоками, чтобы не держать полную копию
+        scores = np.empty((len(queries), len(self.ids)), dtype=np.float32)
+        for start in range(0, len(self.ids), SCORE_BLOCK_ROWS):
+            block = self.vectors[start:start + SCORE_BLOCK_ROWS].astype(np.float32)
+            scores[:, start:start + len(block)] = queries @ block.T
+        if self.precision == PRECISION_INT8:
+            scores *= self.scales
+        return scores
+
+    def row_vectors(self, rows: List[int]) -> np.ndarray:
+        """Нормированные float32-векторы строк по хранимой матрице (для int8 - с масштабами строк)."""
+        vectors = self.vectors[rows].astype(np.float32)
+        if self.precision == PRECISION_INT8:
+            vectors *= self.scales[rows][:, None]
+        return normalize(vectors)
+
+    def full_vectors(self, rows: List[int]) -> Dict[int, np.ndarray]:
+        """Нормированные векторы строк из float16-файла для пересчета (в float32): {строка: вектор}."""
+        if not rows:
+            return {}
+        # Под блокировкой: save и drop могут закрыть отображение файла (release_rescore_vectors)
+        with _numpy_io_lock:
+            if not self.can_rescore():
+                return {}
+            vectors = np.array(self.rescore_vectors[rows])
+        return dict(zip(rows, normalize(vectors)))
+
+    def release_rescore_vectors(self) -> None:
+        """
+        Закрывает отображение файла для пересчета, чтобы его можно было заменить или удалить
+        (Windows не дает этого сделать с отображенным файлом). Вызывается под _numpy_io_lock.
+        Индекс дальше ищет без пересчета, по int8.
+        """
+        if isinstance(self.rescore_vectors, np.memmap):
+            # Других ссылок на отображение нет: строки читаются копией под той же блокировкой
+            self.rescore_vectors = None
+
+    def query(self, query_embeddings: np.ndarray, n_results: int,
+              include_embeddings: bool = False) -> List[List[Dict]]:
+        queries = normalize(np.atleast_2d(query_embeddings))
+        k = min(n_results, len(self.ids))
+        if not k:
+            return [[] for _ in queries]
+
+        scores = self._scores(queries)
+        # Для int8 берем больше кандидатов и уточняем их сходство
+        rescore = self.precision == PRECISION_INT8 and RESCORE_FACTOR > 1
+        candidates = min(k * RESCORE_FACTOR, scores.shape[1]) if rescore else k
+        if candidates < scores.shape[1]:
+            top = np.argpartition(-scores, candidates - 1, axis=1)[:, :candidates]
+        else:
+            top = np.tile(np.arange(scores.shape[1]), (len(queries), 1))
+        top_scores = np.take_along_axis(scores, top, axis=1)
+
+        full = {}
+        if rescore:
+            candidate_rows = sorted(set(top.ravel().tolist()))
+            full = self.full_vectors(candidate_rows)
+            if len(full) < len(candidate_rows):
+                # Индекс старого формата, до перестроения - сходство по int8
+                print(f"Пересчет кандидатов по float16: нет векторов для {len(candidate_rows) - len(full)} "
+                      f"из {len(candidate_rows)} кандидатов, для них сходство по {self.precision}")
+            if full:
+                for qi, row in enumerate(top):
+                    for ci, j in enumerate(row.tolist()):
+                        if j in full:
+                            top_scores[qi, ci] = float(full[j] @ queries[qi])
+
+        order = np.argsort(-top_scores, axis=1)[:, :k]
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+        results = [
+            [
+                {"id": self.ids[j], "text": self.documents[j], "metadata": self.metadatas[j], "similarity": float(score)}
+                for j, score in zip(row, row_scores)
+            ]
+            for row, row_scores in zip(top.tolist(), top_scores.tolist())
+        ]
+        if include_embeddings:
+            # Векторы для пересчета, если они уже прочитаны, иначе - из хранимой матрицы
+            rows = sorted(set(top.ravel().tolist()))
+            vectors = dict(zip(rows, self.row_vectors(rows)))
+            vectors.update(full)
+            for row, matches in zip(top.tolist(), results):
+                for j, match in zip(row, matches):
+                    match["embedding"] = vectors[j]
+        return results
+
+    def save(self) -> None:
+        # Пишем во временные файлы и атомарно заменяем, чтобы поиск не прочитал недописанный индекс
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_vectors = self.path.with_suffix(f".{os.getpid()}.tmp.npy")
+        tmp_meta = self.meta_path.with_suffix(f".{os.getpid()}.tmp.json")
+        tmp_rescore = self.path.with_suffix(f".{os.getpid()}.tmp.rescore.npy")
+        with open(tmp_vectors, 'wb') as f:
+            np.save(f, np.ascontiguousarray(self.vectors))
+        if self.rescore_vectors is not None:
+            with open(tmp_rescore, 'wb') as f:
+                np.save(f, np.ascontiguousarray(self.rescore_vectors))
+        meta = {
+            "precision": self.precision,
+            "ids": self.ids,
+            "documents": self.documents,
+            "metadatas": self.metadatas
+        }
+        if self.precision == PRECISION_INT8:
+            meta["scales"] = self.scales.tolist()
+        with open(tmp_meta, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        with _numpy_io_lock:
+            release_loaded_store(self.path)
+            os.replace(tmp_meta, self.meta_path)
+            os.replace(tmp_vectors, self.path)
+            if self.rescore_vectors is not None:
+                os.replace(tmp_rescore, self.rescore_path)
+            else:
+                self.rescore_path.unlink(missing_ok=True)
+
+    def drop(self) -> None:
+        with _numpy_io_lock:
+            release_loaded_store(self.path)
+            for path in (self.path, self.meta_path, self.rescore_path):
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+
+
+class ChromaVectorStore(VectorStore):
+    """Коллекция ChromaDB с HNSW-индексом - для больших коллекций."""
+
+    backend = BACKEND_CHROMA
+
+    def __init__(self, collection, client=None):
+        self.collection = collection
+        self.client = client or get_chroma_client()
+
+    @classmethod
+    def create(cls, name: str, client=None, m: Optional[int] = None, construction_ef: Optional[int] = None,
+               search_ef: Optional[int] = None) -> "ChromaVectorStore":
+        """
+        Коллекция с заданными параметрами HNSW (не указанные берутся из HNSW_*).
+        Все три параметра задаются при создании: HNSW-индекс, уже загруженный процессом,
+        изменение ef_search через collection.modify не подхватывает.
+        """
+        client = client or get_chroma_client()
+        collection = client.get_or_create_collection(
+            name=name,
+            metadata=hnsw_metadata(m, construction_ef, search_ef)
+        )
+        return cls(collection, client)
+
+    def hnsw_params(self) -> Dict:
+        """Действующие параметры HNSW коллекции."""
+        hnsw = (self.collection.configuration or {}).get("hnsw") or {}
+        return {"M": hnsw.get("max_neighbors"), "construction_ef": hnsw.get("ef_construction"),
+                "search_ef": hnsw.get("ef_search")}
+
+    def count(self) -> int:
+        return self.collection.count()
+
+    def get_indexed_documents(self) -> Optional[Dict[str, Dict]]:
+        existing = self.collection.get(include=["metadatas"])
+        return group_by_document(existing["ids"], existing["metadatas"])
+
+    def get_chunks(self, ids: Optional[List[str]] = None) -> Dict[str, Tuple[str, Dict]]:
+        if ids is not None and not ids:
+            return {}
+        existing = self.collection.get(ids=ids, include=["documents", "metadatas"])
+        return {chunk_id: (document, metadata)
+                for chunk_id, document, metadata in zip(existing["ids"], existing["documents"], existing["metadatas"])}
+
+    def upsert(self, ids: List[str], embeddings: np.ndarray, documents: List[str], metadatas: List[Dict]) -> None:
+        # Добавляем батчами (ограничение ChromaDB)
+        for i in range(0, len(ids), CHROMA_BATCH_SIZE):
+            end_idx = min(i + CHROMA_BATCH_SIZE, len(ids))
+            self.collection.upsert(
+                embeddings=embeddings[i:end_idx].tolist(),
+                documents=documents[i:end_idx],
+                metadatas=metadatas[i:end_idx],
+                ids=ids[i:end_idx]
+            )
+            print(f"  Добавлено {end_idx}/{len(ids)} чанков")
+
+    def update_metadatas(self, ids: List[str], metadatas: List[Dict]) -> None:
+        for i in range(0, len(ids), CHROMA_BATCH_SIZE):
+            self.collection.update(ids=ids[i:i + CHROMA_BATCH_SIZE], metadatas=metadatas[i:i + CHROMA_BATCH_SIZE])
+
+    def delete_documents(self, doc_hashes: List[str]) -> None:
+        for doc_hash in doc_hashes:
+            self.collection.delete(where={"doc_hash": doc_hash})
+
+    def query(self, query_embeddings: np.ndarray, n_results: int,
+              include_embeddings: bool = False) -> List[List[Dict]]:
+        query_embeddings = np.atleast_2d(query_embeddings)
+        if not self.count():
+            return [[] for _ in query_embeddings]
+        include = ["documents", "metadatas", "distances"] + (["embeddings"] if include_embeddings else [])
+        results = self.collection.query(
+            query_embeddings=query_embeddings.tolist(),
+            n_results=n_results,
+            include=include
+        )
+        matches = [
+            [
+                {"id": chunk_id, "text": document, "metadata": metadata, "similarity": 1 - distance}
+                for chunk_id, document, metadata, distance in zip(ids, documents, metadatas, distances)
+            ]
+            for ids, documents, metadatas, distances in zip(
+                results['ids'], results['documents'], results['metadatas'], results['distances']
+            )
+        ]
+        if include_embeddings:
+            for query_matches, embeddings in zip(matches, results['embeddings']):
+                for match, embedding in zip(query_matches, normalize(np.asarray(embeddings))):
+                    match["embedding"] = embedding
+        return matches
+
+    def drop(self) -> None:
+        try:
+            self.client.delete_collection(self.collection.name)
+        except Exception:
+            pass
+
+
+def numpy_index_path(chat_id: Optional[int] = None) -> Path:
+    return artifact_path(chat_id, "vectors.npy")
+
+
+_loaded_numpy_stores: "OrderedDict[Path, tuple]" = OrderedDict()  # {путь: (mtime, индекс)}, порядок - LRU
+_loaded_numpy_stores_lock = threading.Lock()
+
+
+def open_vector_store(chat_id: Optional[int] = None, cached: bool = True) -> Optional[VectorStore]:
+    """
+    Открывает существующий индекс чата (любого бэкенда) или возвращает None.
+    С cached=True индекс NumPy переиспользуется между поисками, пока файл не изменился
+    (в памяти держатся LOADED_NUMPY_STORES_MAX последних использованных индексов);
+    для изменения индекса нужна собственная копия (cached=False).
+    """
+    path = numpy_index_path(chat_id)
+    if path.exists() and not cached:
+        return NumpyVectorStore.load(path, mmap_rescore=False)
+    if path.exists():
+        mtime = path.stat().st_mtime_ns
+        with _loaded_numpy_stores_lock:
+            entry = _loaded_numpy_stores.get(path)
+            if entry is not None and entry[0] == mtime:
+                _loaded_numpy_stores.move_to_end(path)
+                return entry[1]
+        # Загрузка и регистрация в кэше - под одной блокировкой с save/drop: иначе save
+        # не увидел бы только что отображенный файл пересчета и не смог бы его заменить
+        with _numpy_io_lock:
+            store = NumpyVectorStore._load_locked(path)
+            mtime = path.stat().st_mtime_ns
+            released = []
+            with _loaded_numpy_stores_lock:
+                previous = _loaded_numpy_stores.pop(path, None)
+                if previous is not None:
+                    released.append(previous[1])
+                _loaded_numpy_stores[path] = (mtime, store)
+                while len(_loaded_numpy_stores) > LOADED_NUMPY_STORES_MAX:
+                    released.append(_loaded_numpy_stores.popitem(last=False)[1][1])
+            # Вытесненные индексы могут еще использоваться поиском, но файлы пересчета не держат
+            for old_store in released:
+                old_store.release_rescore_vectors()
+        return store
+
+    try:
+        collection = get_chroma_client().get_collection(collection_name(chat_id))
+    except Exception:
+        return None
+    return ChromaVectorStore(collection)
+
+
+def release_loaded_store(path: Path) -> None:
+    """
+    Убирает NumPy-индекс из памяти и закрывает отображение его файла для пересчета
+    перед заменой или удалением файлов. Вызывается под _numpy_io_lock.
+    """
+    with _loaded_numpy_stores_lock:
+        entry = _loaded_numpy_stores.pop(Path(path), None)
+    if entry is not None:
+        entry[1].release_rescore_vectors()
+
+
+def forget_loaded_store(chat_id: Optional[int] = None) -> None:
+    """Убирает NumPy-индекс чата из памяти (при удалении чата)."""
+    with _numpy_io_lock:
+        release_loaded_store(numpy_index_path(chat_id))
+
+
+def store_matches(store: VectorStore, backend: str) -> bool:
+    """
+    Подходит ли существующий индекс под выбранный бэкенд и текущие настройки:
+    точность хранения для NumPy, параметры HNSW_* для ChromaDB (их нельзя изменить
+    у созданной коллекции). Непустой int8-индекс без векторов для пересчета
+    (старого формата) перестраивается.
+    """
+    if store.backend != backend:
+        return False
+    if backend == BACKEND_CHROMA:
+        return store.hnsw_params() == {"M": HNSW_M, "construction_ef": HNSW_CONSTRUCTION_EF,
+                                       "search_ef": HNSW_SEARCH_EF}
+    if backend != BACKEND_NUMPY:
+        return True
+    if store.precision != VECTOR_PRECISION:
+        return False
+    return store.precision != PRECISION_INT8 or not store.count() or store.can_rescore()
+
+
+def create_vector_store(chat_id: Optional[int], backend: str) -> VectorStore:
+    """Создает пустой индекс чата выбранного бэкенда."""
+    if backend == BACKEND_NUMPY:
+        return NumpyVectorStore(numpy_index_path(chat_id), VECTOR_PRECISION)
+    if backend == BACKEND_CHROMA:
+        return ChromaVectorStore.create(collection_name(chat_id))
+    raise ValueError(f"Неизвестный бэкенд векторного индекса: {backend}")
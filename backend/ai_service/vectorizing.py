@@ -1,173 +1,484 @@
+import hashlib
 import json
-from sentence_transformers import SentenceTransformer
-import chromadb
-from typing import Dict, List
+import re
+from array import array
+from functools import partial
+from bisect import bisect_left, bisect_right
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from ai_service.chat_workspace import artifact_path
+from ai_service.dedup import MinHashLSH, find_near_duplicates, load_signatures, save_signatures
+from ai_service.embedding_cache import get_embedding_cache
+from ai_service.embeddings import EMBEDDING_MODEL, encode_texts, get_model
+from ai_service.vector_store import ChromaVectorStore, VectorStore, choose_backend, create_vector_store, open_vector_store, store_matches
 
 CHUNK_SIZE = 700  # символов на чанк
 CHUNK_OVERLAP = 100  # перекрытие между чанками
-EMBEDDING_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2" 
+CHUNK_BY_TOKENS = False  # считать размер чанка в токенах модели эмбеддингов, а не в символах
+CHUNK_SIZE_TOKENS = 128  # токенов на чанк (максимальная длина входа MiniLM)
+CHUNK_OVERLAP_TOKENS = 16  # перекрытие между чанками в токенах
+BOUNDARY_LOOKAHEAD = 50  # насколько символов искать границу после CHUNK_SIZE
+MIN_CHUNK_CHARS = 50  # более короткие чанки игнорируются
+DEDUP_CHUNKS = True  # отбрасывать почти-дубликаты чанков перед созданием эмбеддингов
+INDEX_BATCH_CHUNKS = 4096  # чанков, тексты которых создаются, кодируются и пишутся в индекс за раз
+
+SENTENCE_BOUNDARY_CHARS = ".!?;\n"  # символы конца предложения
+WORD_BOUNDARY_CHARS = " \t\r\n,"  # символы конца слова
+SENTENCE_BOUNDARY_RE = re.compile(f"[{re.escape(SENTENCE_BOUNDARY_CHARS)}]")
+WORD_BOUNDARY_RE = re.compile(f"[{re.escape(WORD_BOUNDARY_CHARS)}]")
+NON_SPACE_RE = re.compile(r"\S")
+
+def chunking_params() -> Dict:
+    """Параметры, от которых зависят чанки и их эмбеддинги."""
+    return {
+        "chunk_by_tokens": CHUNK_BY_TOKENS,
+        "chunk_size": CHUNK_SIZE_TOKENS if CHUNK_BY_TOKENS else CHUNK_SIZE,
+        "chunk_overlap": CHUNK_OVERLAP_TOKENS if CHUNK_BY_TOKENS else CHUNK_OVERLAP,
+        "min_chunk_chars": MIN_CHUNK_CHARS,
+        "embedding_model": EMBEDDING_MODEL
+    }
 
-def split_into_chunks(text: str, source_id: int) -> List[Dict]:
+def document_hash(pages: List[str], params: Optional[Dict] = None) -> str:
     """
-    Разбивает текст на перекрывающиеся чанки.
-    Возвращает список словарей с чанками и метаданными.
+    Ключ документа в векторной базе: SHA-256 текста страниц и параметров чанкинга.
+    Если не изменились ни текст, ни параметры, чанки и эмбеддинги документа те же.
     """
-    chunks = []
+    digest = hashlib.sha256(json.dumps(params or chunking_params(), sort_keys=True).encode('utf-8'))
+    for page_text in pages:
+        digest.update(b"\f")
+        digest.update((page_text or "").encode('utf-8'))
+    return digest.hexdigest()
+
+def join_pages(pages: Iterable[Tuple[int, str]]) -> Tuple[str, List[int], List[int]]:
+    """
+    Склеивает поток страниц в один текст за один проход.
+    Возвращает (текст, смещения_начала_страниц, номера_страниц).
+    """
+    parts = []
+    page_starts = []
+    page_numbers = []
+    offset = 0
+    for page_num, page_text in pages:
+        if not page_text:
+            continue
+        page_starts.append(offset)
+        page_numbers.append(page_num)
+        parts.append(page_text)
+        parts.append("\n")
+        offset += len(page_text) + 1
+    return "".join(parts), page_starts, page_numbers
+
+def _first_boundary(text: str, pattern: re.Pattern, lo: int, hi: int) -> Optional[int]:
+    """Позиция сразу после первого символа-границы в text[lo:hi] или None."""
+    match = pattern.search(text, lo, hi)
+    return match.end() if match else None
+
+def _last_boundary(text: str, chars: str, lo: int, hi: int) -> Optional[int]:
+    """Позиция сразу после последнего символа-границы в text[lo:hi] или None."""
+    pos = max(text.rfind(char, lo, hi) for char in chars)
+    return pos + 1 if pos >= 0 else None
+
+def longer_than(text: str, start: int, end: int, min_chars: int) -> bool:
+    """
+    len(text[start:end].strip()) > min_chars без копирования среза: после первого
+    непробельного символа должен найтись еще один не ближе чем через min_chars.
+    """
+    first = NON_SPACE_RE.search(text, start, end)
+    return first is not None and NON_SPACE_RE.search(text, first.start() + min_chars, end) is not None
+
+def chunk_spans(text: str, chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP,
+                tokenizer=None) -> Iterator[Tuple[int, int]]:
+    """
+    Отдает границы (start, end) перекрывающихся чанков за линейное время.
+    Конец чанка переносится на ближайшую границу предложения, если ее нет - слова.
+    Границы ищутся скомпилированными регулярками (назад - str.rfind) только в небольшом
+    окне у конца чанка, без посимвольного цикла на Python.
+    Без tokenizer размеры в символах и граница ищется в BOUNDARY_LOOKAHEAD символах
+    после chunk_size. С tokenizer (быстрый токенизатор модели эмбеддингов) размеры
+    в токенах, а граница ищется назад, чтобы чанк не превысил chunk_size токенов.
+    Каждый следующий чанк начинается строго правее предыдущего.
+    """
+    if chunk_overlap >= chunk_size:
+        raise ValueError("Перекрытие чанков должно быть меньше размера чанка")
     
-    # Простое чанкование по количеству символов с перекрытием
-    start = 0
-    chunk_num = 1
+    text_len = len(text)
+    if not text_len:
+        return
+    if tokenizer is None:
+        yield from _char_chunk_spans(text, chunk_size, chunk_overlap)
+        return
+    
+    offsets = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True,
+                        verbose=False)["offset_mapping"]
+    token_starts = array('l', (token_start for token_start, _ in offsets))
+    token_ends = array('l', (token_end for _, token_end in offsets))
+    if not token_ends:
+        return
     
-    while start < len(text):
-        # Определяем конец чанка
-        end = start + CHUNK_SIZE
+    start = 0
+    while start < text_len:
+        first_token = bisect_right(token_ends, start)
+        last_token = min(first_token + chunk_size, len(token_ends)) - 1
+        target = token_ends[last_token]
+        if last_token == len(token_ends) - 1:
+            end = text_len
+        else:
+            # Не короче половины чанка, чтобы граница не съедала размер
+            window_start = start + (target - start) // 2
+            end = (_last_boundary(text, SENTENCE_BOUNDARY_CHARS, window_start, target)
+                   or _last_boundary(text, WORD_BOUNDARY_CHARS, window_start, target)
+                   or target)
         
-        # Если это не последний чанк и мы не на границе слова, пытаемся найти границу предложения
-        if end < len(text):
-            # Ищем точку, пробел или перевод строки для более аккуратного разрыва
-            for i in range(min(50, len(text) - end)):  # смотрим вперед на 50 символов
-                if text[end + i] in {'.', '!', '?', '\n', ' ', ';', ','}:
-                    end = end + i + 1
-                    break
+        yield start, end
+        if end >= text_len:
+            break
         
-        chunk_text = text[start:end].strip()
+        # end < text_len, поэтому end_token - существующий токен
+        end_token = bisect_left(token_ends, end)
+        next_start = token_starts[max(end_token - chunk_overlap, first_token + 1)]
+        # Следующий чанк начинаем с начала слова внутри перекрытия
+        next_start = _first_boundary(text, WORD_BOUNDARY_RE, next_start - 1, end - 1) or next_start
+        start = max(next_start, start + 1)
+
+def _char_chunk_spans(text: str, chunk_size: int, chunk_overlap: int) -> Iterator[Tuple[int, int]]:
+    """
+    Символьный режим chunk_spans. Это самый частый путь, поэтому поиск регулярками
+    вызывается напрямую, без вспомогательных функций: на корпусе bench_chunking
+    накладные расходы Python на чанк сравнимы со стоимостью самого поиска.
+    """
+    text_len = len(text)
+    sentence_search = SENTENCE_BOUNDARY_RE.search
+    word_search = WORD_BOUNDARY_RE.search
+    start = 0
+    while True:
+        target = start + chunk_size
+        if target >= text_len:
+            yield start, text_len
+            return
+        window_end = target + BOUNDARY_LOOKAHEAD
+        match = sentence_search(text, target, window_end) or word_search(text, target, window_end)
+        end = match.end() if match else target
+        yield start, end
+        if end >= text_len:
+            return
+        # Следующий чанк начинаем с начала слова внутри перекрытия
+        next_start = end - chunk_overlap
+        match = word_search(text, next_start - 1, end - 1)
+        start = max(match.end() if match else next_start, start + 1)
+
+class ChunkTable:
+    """
+    Колоночная таблица чанков: номера источников, номера чанков, смещения и страницы
+    хранятся в компактных массивах, а текст чанка - это срез исходного документа,
+    который создается только по запросу (для модели эмбеддингов или векторной базы).
+    """
+    
+    def __init__(self):
+        self.documents: Dict[int, str] = {}  # {номер_источника: склеенный текст}
+        self.doc_hashes: Dict[int, str] = {}  # {номер_источника: ключ документа}
+        self.source_ids = array('l')
+        self.chunk_nums = array('l')
+        self.starts = array('l')
+        self.ends = array('l')
+        self.pages = array('l')
+    
+    def __len__(self) -> int:
+        return len(self.starts)
+    
+    def add_document(self, source_id: int, pages: Iterable[Tuple[int, str]],
+                     chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP,
+                     tokenizer=None, doc_hash: Optional[str] = None) -> int:
+        """
+        Добавляет документ и его чанки.
+        - pages: поток пар (номер_страницы, текст_страницы)
+        - tokenizer: если передан, chunk_size и chunk_overlap считаются в его токенах
+        - doc_hash: ключ документа (см. document_hash); если задан, id чанков
+          строятся от него и не зависят от номера источника в чате
+        Возвращает число добавленных чанков.
+        Номер страницы чанка - настоящая страница, на которой начинается чанк.
+        """
+        text, page_starts, page_numbers = join_pages(pages)
+        self.documents[source_id] = text
+        if doc_hash:
+            self.doc_hashes[source_id] = doc_hash
+        chunk_num = 0
         
-        if chunk_text and len(chunk_text) > 50:  # Игнорируем слишком короткие чанки
-            # Приблизительный номер страницы (грубая оценка)
-            approx_page = (start // 2000) + 1  # предполагаем ~2000 символов на страницу
-            
-            chunks.append({
-                "source_id": source_id,
-                "chunk_num": chunk_num,
-                "approx_page": approx_page,
-                "text": chunk_text,
-                "start_char": start,
-                "end_char": end
-            })
+        for start, end in chunk_spans(text, chunk_size, chunk_overlap, tokenizer):
+            # Игнорируем слишком короткие чанки
+            if not longer_than(text, start, end, MIN_CHUNK_CHARS):
+                continue
             chunk_num += 1
+            self.source_ids.append(source_id)
+            self.chunk_nums.append(chunk_num)
+            self.starts.append(start)
+            self.ends.append(end)
+            # Страница, на которой начинается чанк
+            self.pages.append(page_numbers[bisect_right(page_starts, start) - 1])
         
-        # Сдвигаем стартовую позицию с перекрытием
-        start = end - CHUNK_OVERLAP
+        return chunk_num
+    
+    def text(self, i: int) -> str:
+        return self.documents[self.source_ids[i]][self.starts[i]:self.ends[i]].strip()
     
-    return chunks
+    def texts(self, indices: Optional[Iterable[int]] = None) -> List[str]:
+        """Материализует тексты чанков (все или по списку индексов)."""
+        return list(self.iter_texts(indices))
+    
+    def iter_texts(self, indices: Optional[Iterable[int]] = None) -> Iterator[str]:
+        """Тексты чанков по одному, без списка всех текстов сразу."""
+        if indices is None:
+            indices = range(len(self))
+        return (self.text(i) for i in indices)
+    
+    def chunk_id(self, i: int) -> str:
+        prefix = self.doc_hashes.get(self.source_ids[i], self.source_ids[i])
+        return f"{prefix}_{self.chunk_nums[i]}"
+    
+    def metadata(self, i: int) -> Dict:
+        metadata = {
+            "source_id": self.source_ids[i],
+            "chunk_num": self.chunk_nums[i],
+            "approx_page": self.pages[i],
+            "start_char": self.starts[i],
+            "end_char": self.ends[i]
+        }
+        doc_hash = self.doc_hashes.get(self.source_ids[i])
+        if doc_hash:
+            metadata["doc_hash"] = doc_hash
+        return metadata
 
-def create_vector_db(relevant_texts: Dict[int, str], collection_name: str = "research_papers") -> chromadb.Collection:
+def split_into_chunks(pages: Iterable[Tuple[int, str]], source_id: int,
+                      chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP,
+                      tokenizer=None) -> List[Dict]:
     """
-    Создает векторную базу данных из релевантных текстов.
-    Возвращает коллекцию ChromaDB.
+    Разбивает постраничный текст на перекрывающиеся чанки.
+    Возвращает список словарей с чанками и метаданными (см. ChunkTable.add_document).
     """
+    table = ChunkTable()
+    table.add_document(source_id, pages, chunk_size, chunk_overlap, tokenizer)
+    return [{**table.metadata(i), "text": table.text(i)} for i in range(len(table))]
+
+def duplicate_docs(metadata: Dict) -> set:
+    """Ключи документов, чанки которых слиты с этим чанком как почти-дубликаты."""
+    return set(filter(None, metadata.get("duplicate_docs", "").split(",")))
+
+def drop_near_duplicates(table: ChunkTable, store: VectorStore, stored_ids: List[str],
+                         chat_id: Optional[int] = None) -> Tuple[List[int], Dict[int, Dict]]:
+    """
+    Отбрасывает новые чанки, почти совпадающие (MinHash/LSH) с другими новыми
+    или с уже проиндексированными чанками (stored_ids). Оригиналу в метаданных
+    duplicate_docs запоминаются документы слитых с ним дубликатов.
+    Сигнатуры чанков индекса хранятся рядом с ним (minhash_signatures.npz): текст
+    из индекса читается только для чанков, сигнатур которых там нет.
+    Возвращает (индексы оставшихся чанков таблицы, {индекс: доп. метаданные}).
+    """
+    signatures_path = artifact_path(chat_id, 'minhash_signatures.npz')
+    saved = load_signatures(signatures_path)
+    signatures = {chunk_id: saved[chunk_id] for chunk_id in stored_ids if chunk_id in saved}
+    missing = [chunk_id for chunk_id in stored_ids if chunk_id not in signatures]
+    if missing:
+        print(f"Сигнатуры MinHash для {len(missing)} чанков индекса считаются заново")
+        lsh = MinHashLSH()
+        signatures.update({chunk_id: lsh.signature(text) for chunk_id, (text, _) in store.get_chunks(missing).items()})
     
-    print("Инициализация модели для эмбеддингов...")
-    embedding_model = SentenceTransformer(EMBEDDING_MODEL)
+    duplicates, new_signatures = find_near_duplicates(table.iter_texts(), signatures)
     
-    print("Настройка ChromaDB...")
-    # Создаем персистентную базу в папке chroma_db
-    client = chromadb.PersistentClient(path="./chroma_db")
+    merged: Dict = {}  # {оригинал: ключи документов дубликатов}
+    for i, original in duplicates.items():
+        doc_hash = table.doc_hashes.get(table.source_ids[i])
+        if isinstance(original, int) and table.source_ids[original] == table.source_ids[i]:
+            continue  # повтор внутри одного документа уходит вместе с документом
+        merged.setdefault(original, set()).add(doc_hash)
     
-    # Удаляем старую коллекцию если существует
-    try:
-        client.delete_collection(collection_name)
-    except:
-        pass
-    
-    # Создаем новую коллекцию
-    collection = client.create_collection(
-        name=collection_name,
-        metadata={"hnsw:space": "cosine"}  # используем косинусное расстояние
-    )
-    
-    all_chunks = []
-    all_metadatas = []
-    all_ids = []
-    
-    print("Обработка источников и создание чанков...")
-    for source_id, text in relevant_texts.items():
-        chunks = split_into_chunks(text, source_id)
-        
-        for chunk in chunks:
-            chunk_id = f"{source_id}_{chunk['chunk_num']}"
-            
-            all_chunks.append(chunk["text"])
-            all_metadatas.append({
-                "source_id": source_id,
-                "chunk_num": chunk["chunk_num"],
-                "approx_page": chunk["approx_page"],
-                "start_char": chunk["start_char"],
-                "end_char": chunk["end_char"]
-            })
-            all_ids.append(chunk_id)
-        
-        print(f"  Источник #{source_id}: создано {len(chunks)} чанков")
+    def merge(metadata: Dict, doc_hashes: set) -> str:
+        return ",".join(sorted(duplicate_docs(metadata) | doc_hashes))
+    
+    extra_metadata = {}
+    for original, doc_hashes in merged.items():
+        if isinstance(original, int):
+            extra_metadata[original] = {"duplicate_docs": merge({}, doc_hashes)}
+    originals = store.get_chunks([original for original in merged if not isinstance(original, int)])
+    if originals:
+        store.update_metadatas(list(originals), [{**metadata, "duplicate_docs": merge(metadata, merged[chunk_id])}
+                                                 for chunk_id, (_, metadata) in originals.items()])
     
-    print(f"Всего чанков: {len(all_chunks)}")
+    kept = [i for i in range(len(table)) if i not in duplicates]
+    signatures.update({table.chunk_id(i): new_signatures[i] for i in kept})
+    save_signatures(signatures_path, signatures)
+    
+    print(f"Почти-дубликатов отброшено: {len(duplicates)} из {len(table)} новых чанков")
+    return kept, extra_metadata
+
+def create_vector_db(relevant_texts: Dict[int, List[str]], chat_id: Optional[int] = None) -> VectorStore:
+    """
+    Создает или инкрементально обновляет векторный индекс чата из релевантных текстов.
+    - relevant_texts: словарь {номер_источника: список_текстов_страниц}
+    Документы сопоставляются по ключу (хэш текста и параметров чанкинга):
+    новые чанкуются и эмбеддятся, удаленные вычищаются по метаданным,
+    у неизменных при необходимости обновляется только номер источника.
+    Бэкенд (NumPy или ChromaDB) выбирается по итоговому числу чанков.
+    Возвращает индекс (VectorStore).
+    """
     
-    if not all_chunks:
-        print("Ошибка: нет чанков для обработки!")
-        return collection
+    embedding_model = get_model(EMBEDDING_MODEL)
     
-    print("Создание эмбеддингов...")
-    # Создаем эмбеддинги для всех чанков
-    embeddings = embedding_model.encode(all_chunks, show_progress_bar=True, convert_to_numpy=True)
+    params = chunking_params()
+    current = {}  # {ключ_документа: номер_источника}
+    for source_id, pages in relevant_texts.items():
+        doc_hash = document_hash(pages, params)
+        if doc_hash in current:
+            print(f"  Источник #{source_id} совпадает с #{current[doc_hash]}, пропускаем")
+            continue
+        current[doc_hash] = source_id
     
-    print("Добавление в векторную базу...")
-    # Добавляем в коллекцию батчами (ограничение ChromaDB)
-    batch_size = 100
-    for i in range(0, len(all_chunks), batch_size):
-        end_idx = min(i + batch_size, len(all_chunks))
-        
-        collection.add(
-            embeddings=embeddings[i:end_idx].tolist(),
-            documents=all_chunks[i:end_idx],
-            metadatas=all_metadatas[i:end_idx],
-            ids=all_ids[i:end_idx]
-        )
-        
-        print(f"  Добавлено {end_idx}/{len(all_chunks)} чанков")
+    store = open_vector_store(chat_id, cached=False)
+    indexed = store.get_indexed_documents() if store is not None else {}
+    if indexed is None:
+        # Чанки без ключа документа не сопоставить, пересоздаем индекс
+        print("Индекс старого формата, пересоздаем...")
+        store.drop()
+        store, indexed = None, {}
     
-    print(f"Векторная база создана. Коллекция: {collection_name}")
-    print(f"Всего документов: {collection.count()}")
+    def chunk_documents(doc_hashes: List[str]) -> ChunkTable:
+        table = ChunkTable()
+        for doc_hash in doc_hashes:
+            source_id = current[doc_hash]
+            pages = enumerate(relevant_texts[source_id], start=1)
+            if CHUNK_BY_TOKENS:
+                count = table.add_document(source_id, pages, CHUNK_SIZE_TOKENS, CHUNK_OVERLAP_TOKENS,
+                                           embedding_model.tokenizer, doc_hash=doc_hash)
+            else:
+                count = table.add_document(source_id, pages, doc_hash=doc_hash)
+            print(f"  Источник #{source_id}: создано {count} чанков")
+        return table
     
-    return collection
+    # Записи о слитых документах, которых больше нет в списке, убираем: иначе такой документ,
+    # добавленный снова, считался бы уже проиндексированным
+    cleaned = set()
+    for doc_hash, entry in indexed.items():
+        for metadata in entry["metadatas"]:
+            stale = duplicate_docs(metadata) - current.keys()
+            if stale and doc_hash in current:
+                metadata["duplicate_docs"] = ",".join(sorted(duplicate_docs(metadata) - stale))
+                cleaned.add(doc_hash)
+    
+    # Документ, все чанки которого слиты с чанками других документов, своих чанков
+    # в индексе не имеет, но тоже проиндексирован
+    merged_docs = {duplicate_doc for entry in indexed.values() for metadata in entry["metadatas"]
+                   for duplicate_doc in duplicate_docs(metadata)}
+    
+    # Удаляемые документы и документы, чьи чанки были слиты с чанками удаляемых (в том числе
+    # через переиндексируемые): такие документы переиндексируются целиком, чтобы их текст не пропал
+    removed = [doc_hash for doc_hash in indexed if doc_hash not in current]
+    orphaned = set()
+    released = removed
+    while released:
+        released = {
+            duplicate_doc
+            for doc_hash in released if doc_hash in indexed
+            for metadata in indexed[doc_hash]["metadatas"]
+            for duplicate_doc in duplicate_docs(metadata)
+            if duplicate_doc in current and duplicate_doc not in orphaned
+        }
+        orphaned |= released
+    
+    print("Обработка новых источников и создание чанков...")
+    added = [doc_hash for doc_hash in current
+             if (doc_hash not in indexed and doc_hash not in merged_docs) or doc_hash in orphaned]
+    table = chunk_documents(added)
+    
+    # Бэкенд выбираем по размеру индекса после обновления
+    total = len(table) + sum(len(indexed[doc_hash]["ids"]) for doc_hash in current
+                             if doc_hash in indexed and doc_hash not in orphaned)
+    backend = choose_backend(total)
+    if store is None or not store_matches(store, backend):
+        if store is not None:
+            # Смена бэкенда, точности или параметров HNSW: переиндексируем все,
+            # эмбеддинги при этом в основном берутся из кэша
+            print(f"Индекс {store.backend}/{store.precision} перестраивается как {backend} ({total} чанков)")
+            store.drop()
+            added, indexed, removed, orphaned = list(current), {}, [], set()
+            table = chunk_documents(added)
+        store = create_vector_store(chat_id, backend)
+    
+    # Удаляем чанки документов, которых больше нет в списке (и переиндексируемых)
+    store.delete_documents(removed + list(orphaned))
+    
+    # Неизменные документы не переиндексируем, только обновляем номер источника (и очищенные duplicate_docs)
+    renumbered = 0
+    for doc_hash, source_id in current.items():
+        entry = indexed.get(doc_hash)
+        if entry is None or doc_hash in orphaned or (entry["source_id"] == source_id and doc_hash not in cleaned):
+            continue
+        store.update_metadatas(entry["ids"], [{**metadata, "source_id": source_id} for metadata in entry["metadatas"]])
+        renumbered += entry["source_id"] != source_id
+    
+    print(f"Документов: новых {len(added)}, удаленных {len(removed)}, "
+          f"без изменений {len(current) - len(added)} (перенумеровано {renumbered})")
+    print(f"Новых чанков: {len(table)}, бэкенд индекса: {store.backend}")
+    
+    indices = list(range(len(table)))
+    extra_metadata = {}  # {индекс_чанка: дополнительные метаданные}
+    if DEDUP_CHUNKS and len(table):
+        stored_ids = [chunk_id for doc_hash, entry in indexed.items()
+                      if doc_hash in current and doc_hash not in orphaned for chunk_id in entry["ids"]]
+        indices, extra_metadata = drop_near_duplicates(table, store, stored_ids, chat_id)
+    
+    if indices:
+        print("Создание эмбеддингов и добавление в векторный индекс...")
+        # Эмбеддинги только для новых чанков; уже посчитанные ранее берутся из дискового кэша.
+        # Тексты чанков создаются пачками по INDEX_BATCH_CHUNKS, а не все сразу
+        embedding_cache = get_embedding_cache(EMBEDDING_MODEL, embedding_model.get_sentence_embedding_dimension())
+        encode = partial(encode_texts, embedding_model, show_progress_bar=True)
+        for batch_start in range(0, len(indices), INDEX_BATCH_CHUNKS):
+            batch = indices[batch_start:batch_start + INDEX_BATCH_CHUNKS]
+            texts = table.texts(batch)
+            store.upsert(
+                ids=[table.chunk_id(i) for i in batch],
+                embeddings=embedding_cache.encode(encode, texts),
+                documents=texts,
+                metadatas=[{**table.metadata(i), **extra_metadata.get(i, {})} for i in batch]
+            )
+            print(f"  Проиндексировано {batch_start + len(batch)}/{len(indices)} чанков")
+    
+    store.save()
+    print(f"Векторный индекс обновлен. Всего чанков: {store.count()}")
+    
+    return store
 
-def search_similar_chunks(collection: chromadb.Collection, query: str, n_results: int = 5) -> List[Dict]:
+def search_similar_chunks(store: VectorStore, query: str, n_results: int = 5) -> List[Dict]:
     """
     Ищет похожие чанки по семантическому запросу.
     """
-    # Используем ту же модель для эмбеддингов
-    embedding_model = SentenceTransformer(EMBEDDING_MODEL)
+    # Используем ту же модель для эмбеддингов (из общего реестра)
+    embedding_model = get_model(EMBEDDING_MODEL)
     
     # Создаем эмбеддинг для запроса
     query_embedding = embedding_model.encode([query], convert_to_numpy=True)
     
-    # Ищем похожие чанки
-    results = collection.query(
-        query_embeddings=query_embedding.tolist(),
-        n_results=n_results,
-        include=["documents", "metadatas", "distances"]
-    )
-    
     # Форматируем результаты
-    similar_chunks = []
-    if results['documents']:
-        for i in range(len(results['documents'][0])):
-            similar_chunks.append({
-                "text": results['documents'][0][i],
-                "source_id": results['metadatas'][0][i]["source_id"],
-                "approx_page": results['metadatas'][0][i]["approx_page"],
-                "chunk_num": results['metadatas'][0][i]["chunk_num"],
-                "similarity_score": 1 - results['distances'][0][i]  # преобразуем расстояние в сходство
-            })
-    
-    return similar_chunks
-
-def initial_vectorizing():
+    return [
+        {
+            "text": match["text"],
+            "source_id": match["metadata"]["source_id"],
+            "approx_page": match["metadata"]["approx_page"],
+            "chunk_num": match["metadata"]["chunk_num"],
+            "similarity_score": match["similarity"]
+        }
+        for match in store.query(query_embedding, n_results)[0]
+    ]
+
+def initial_vectorizing(chat_id: Optional[int] = None):
+    """
+    Строит или обновляет векторную коллекцию чата по его relevant_texts.json.
+    """
     print("=" * 50)
     print("Подготовка RAG базы знаний")
     print("=" * 50)
     
     # Загружаем данные из предыдущих этапов
     try:
-        with open('relevant_texts.json', 'r', encoding='utf-8') as f:
+        with open(artifact_path(chat_id, 'relevant_texts.json'), 'r', encoding='utf-8') as f:
             relevant_texts = json.load(f)
         # Конвертируем ключи обратно в int (JSON сохраняет как строки)
         relevant_texts = {int(k): v for k, v in relevant_texts.items()}
@@ -179,23 +490,26 @@ def initial_vectorizing():
     print(f"Номера источников: {list(relevant_texts.keys())}")
     
     # Создаем векторную базу
-    create_vector_db(relevant_texts)
+    store = create_vector_db(relevant_texts, chat_id)
     
     # Сохраняем информацию о коллекции
     collection_info = {
-        "collection_name": "research_papers",
+        "backend": store.backend,
+        "precision": store.precision,
+        "num_chunks": store.count(),
         "num_sources": len(relevant_texts),
         "source_ids": list(relevant_texts.keys()),
-        "chunk_size": CHUNK_SIZE,
-        "chunk_overlap": CHUNK_OVERLAP,
-        "embedding_model": EMBEDDING_MODEL
+        **chunking_params()
     }
+    if isinstance(store, ChromaVectorStore):
+        collection_info["hnsw"] = store.hnsw_params()
     
-    with open('vector_db_info.json', 'w', encoding='utf-8') as f:
+    info_path = artifact_path(chat_id, 'vector_db_info.json')
+    with open(info_path, 'w', encoding='utf-8') as f:
         json.dump(collection_info, f, indent=2, ensure_ascii=False)
     
     print("\n" + "=" * 50)
-    print(f"Векторная база сохранена в папке: ./chroma_db/")
-    print(f"Информация о базе: vector_db_info.json")
+    print(f"Векторный индекс ({store.backend}) сохранен")
+    print(f"Информация о базе: {info_path}")
 
     return "Векторизация успешно завершена, переход к генерации обзора"
\ No newline at end of file
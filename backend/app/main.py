@@ -9,22 +9,67 @@ from datetime import datetime
 from . import models
 from .database import engine, get_db
 import asyncio
-from ai_service.collect_files import initial_analyzis
+from ai_service.collect_files import has_unscored_files, initial_analyzis
 from ai_service.vectorizing import initial_vectorizing
-from ai_service.generating import initital_generating, rewrite_review_with_instruction
+from ai_service.generating import initital_generating, rewrite_review_with_instruction, warm_up_search_queries
+from ai_service import llm_client
+from ai_service.llm_cache import response_cache
+from ai_service.chat_workspace import (artifact_path, clear_pipeline_incomplete, delete_chat_data,
+                                       is_pipeline_incomplete, mark_pipeline_incomplete)
+from ai_service import embeddings
 
 from concurrent.futures import ThreadPoolExecutor
 
 # Создаем таблицы
 models.Base.metadata.create_all(bind=engine)
 
+EMBEDDING_WARMUP = True  # загружать модель эмбеддингов при старте, а не на первом запросе
+PIPELINE_WORKERS = 8  # шагов пайплайна (анализ, векторизация, генерация), выполняемых одновременно
+pipeline_executor = ThreadPoolExecutor(max_workers=PIPELINE_WORKERS)
+
+chat_steps = {}  # {chat_id: future последнего запущенного шага пайплайна чата}
+
+async def run_in_pipeline(func, *args, timeout: float, chat_id: Optional[int] = None):
+    """
+    Выполняет шаг пайплайна в общем пуле потоков, не блокируя цикл событий,
+    чтобы пайплайны разных чатов шли параллельно.
+    Шаги одного чата (chat_id) идут строго по очереди: поток шага, по которому истек
+    timeout, продолжает работать с файлами чата, поэтому следующий шаг этого чата
+    сначала ждет его завершения (ожидание входит в timeout).
+    """
+    loop = asyncio.get_running_loop()
+
+    async def run_after_previous():
+        if chat_id is not None:
+            while True:
+                previous = chat_steps.get(chat_id)
+                if previous is None or previous.done():
+                    break
+                print(f"Чат {chat_id}: ждем завершения предыдущего шага пайплайна...")
+                await asyncio.wait([previous])
+        future = loop.run_in_executor(pipeline_executor, func, *args)
+        future.add_done_callback(lambda done: forget_step(chat_id, done))
+        if chat_id is not None:
+            chat_steps[chat_id] = future
+        # shield: по таймауту перестаем ждать, но future отражает реальное завершение потока
+        return await asyncio.shield(future)
+
+    return await asyncio.wait_for(run_after_previous(), timeout=timeout)
+
+def forget_step(chat_id: Optional[int], future: asyncio.Future):
+    """Убирает завершившийся шаг из chat_steps; ошибку брошенного по таймауту шага только печатает."""
+    if chat_steps.get(chat_id) is future:
+        del chat_steps[chat_id]
+    if not future.cancelled() and future.exception() is not None:
+        print(f"Шаг пайплайна чата {chat_id} завершился с ошибкой: {future.exception()!r}")
+
 class ConnectionManager:
     def __init__(self):
         # Простой словарь для хранения соединений
         self.active_connections = {}
     
-    async def send_personal_message(self, message: dict, client_id: str) -> bool:
-        """Отправить сообщение конкретному клиенту"""
+    async def send_personal_message(self, message: dict, client_id: str, log: bool = True) -> bool:
+        """Отправить сообщение конкретному клиенту (log=False - без записи в лог, для потока delta)"""
         if client_id not in self.active_connections:
             print(f"⚠️ Клиент {client_id} не найден в активных соединениях")
             return False
@@ -33,7 +78,8 @@ class ConnectionManager:
         
         try:
             await websocket.send_json(message)
-            print(f"📨 Сообщение отправлено клиенту {client_id}")
+            if log:
+                print(f"📨 Сообщение отправлено клиенту {client_id}")
             return True
         except Exception as e:
             print(f"❌ Ошибка отправки клиенту {client_id}: {e}")
@@ -58,6 +104,47 @@ class ConnectionManager:
                 del self.active_connections[client_id]
 
 manager = ConnectionManager()
+
+async def run_streaming(func, *args, client_id: Optional[str], chat_id: int, stream_id: str, timeout: float):
+    """
+    Выполняет шаг генерации в общем пуле потоков, пересылая клиенту фрагменты текста
+    событиями delta по мере их появления. Последним аргументом func получает
+    колбэк on_delta (None, если клиента нет - тогда генерация идет без потока).
+    """
+    if not client_id:
+        return await run_in_pipeline(func, *args, None, timeout=timeout, chat_id=chat_id)
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+
+    def on_delta(text: str):
+        # Вызывается из потока пула: передаем фрагмент в цикл событий
+        loop.call_soon_threadsafe(queue.put_nowait, text)
+
+    async def forward():
+        # Один отправитель на поток сохраняет порядок фрагментов; накопившиеся
+        # за время отправки фрагменты уходят одним событием
+        while True:
+            parts = [await queue.get()]
+            while not queue.empty():
+                parts.append(queue.get_nowait())
+            text = "".join(part for part in parts if part)
+            if text:
+                await manager.send_personal_message({
+                    "type": "delta",
+                    "stream_id": stream_id,
+                    "chat_id": chat_id,
+                    "delta": text
+                }, client_id, log=False)
+            if None in parts:
+                return
+
+    forwarder = asyncio.create_task(forward())
+    try:
+        return await run_in_pipeline(func, *args, on_delta, timeout=timeout, chat_id=chat_id)
+    finally:
+        queue.put_nowait(None)
+        await forwarder
 app = FastAPI(title="Chat API", version="1.0.0")
 
 # Настройка CORS
@@ -69,6 +156,14 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def warm_up_models():
+    """Прогрев модели эмбеддингов и эмбеддингов фиксированных поисковых запросов"""
+    if EMBEDDING_WARMUP:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(pipeline_executor, embeddings.warm_up)
+        await loop.run_in_executor(pipeline_executor, warm_up_search_queries)
+
 # Папка для загрузки файлов
 UPLOAD_DIR = "uploads"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
@@ -226,6 +321,15 @@ async def create_message(
             saved_files.append(db_file)
     
     
+    # Тема из предыдущего запроса (уточнения обзора темой не считаются)
+    previous_topic_message = db.query(models.Message)\
+        .filter(models.Message.chat_id == chat_id,
+                models.Message.role == "user",
+                ~models.Message.content.startswith("уточнение"))\
+        .order_by(models.Message.created_at.desc())\
+        .first()
+    topic_changed = previous_topic_message is None or previous_topic_message.content != message
+
     # Сохраняем сообщение пользователя
     user_message = models.Message(
         chat_id=chat_id,
@@ -241,12 +345,15 @@ async def create_message(
     print(message)
     if message.startswith("уточнение"):
         print(123123)
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        parent_dir = os.path.dirname(current_dir)
-        file_path = os.path.join(parent_dir, "literature_review.txt")
+        file_path = artifact_path(chat_id, "literature_review.txt")
 
-        with open(file_path, 'r', encoding='utf-8') as f:
-            text = f.read()
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                text = f.read()
+        except FileNotFoundError:
+            # У чатов, созданных до раздельных папок чатов, обзора в папке чата нет.
+            # Общий файл старой версии мог быть перезаписан другим чатом, поэтому его не берем
+            text = None
 
         if client_id:
             final_message = models.Message(
@@ -270,21 +377,19 @@ async def create_message(
                 }
             }, client_id)
 
-        try:
-            with ThreadPoolExecutor() as executor:
-                # Запускаем анализ в отдельном потоке
-                analysis_future = executor.submit(
-                    rewrite_review_with_instruction,
-                    text,           
-                    message      
-                )
-                
-                # Ждем завершения (блокируем, но в отдельном потоке)
-                analysis_result = analysis_future.result(timeout=120) 
-                
-        except Exception as e:
-            # Если ошибка при анализе
-            analysis_result = f"❌ Ошибка при анализе: {str(e)}"
+        stream_id = uuid.uuid4().hex
+        if text is None:
+            analysis_result = ("❌ Обзор для этого чата не найден. Сначала сгенерируйте обзор заново, "
+                               "отправив тему исследования, а затем повторите уточнение.")
+        else:
+            try:
+                # Запускаем в общем пуле потоков, текст приходит клиенту по мере генерации
+                analysis_result = await run_streaming(rewrite_review_with_instruction, text, message,
+                                                      client_id=client_id, chat_id=chat_id, stream_id=stream_id,
+                                                      timeout=120)
+            except Exception as e:
+                # Если ошибка при анализе
+                analysis_result = f"❌ Ошибка при анализе: {str(e)}"
 
         if client_id:
             final_message = models.Message(
@@ -305,7 +410,8 @@ async def create_message(
                     "content": final_message.content,
                     "role": final_message.role,
                     "created_at": final_message.created_at.isoformat()
-                }
+                },
+                "stream_id": stream_id  # заменяет черновик, собранный из delta
             }, client_id)
 
         await manager.broadcast({"type": "chats_updated"})
@@ -363,25 +469,28 @@ async def create_message(
     db_filenames = [f.file_path.split('\\')[1] for f in current_db_files]
     print(db_filenames)
 
-    if not same_lists_flag:
+    # При смене темы анализ повторяется и для тех же файлов: сохраненные summary
+    # переиспользуются, пересчитывается только оценка релевантности.
+    # Повторяется он и если в прошлый раз часть файлов не удалось оценить,
+    # или анализ либо векторизация не дошли до конца (индекс чата отсутствует или устарел)
+    need_analysis = (not same_lists_flag or topic_changed or has_unscored_files(chat_id)
+                     or is_pipeline_incomplete(chat_id))
+    pipeline_failed = False  # шаг упал или не уложился в таймаут - зависящие от него шаги пропускаем
+
+    if need_analysis:
+        # Отметка снимается только после успешной векторизации
+        mark_pipeline_incomplete(chat_id)
         try:
-            with ThreadPoolExecutor() as executor:
-                # Запускаем анализ в отдельном потоке
-                analysis_future = executor.submit(
-                    initial_analyzis, 
-                    message,           
-                    db_filenames       
-                )
-                
-                # Ждем завершения (блокируем, но в отдельном потоке)
-                analysis_result = analysis_future.result(timeout=120)
-                
+            # Запускаем в общем пуле потоков
+            analysis_result = await run_in_pipeline(initial_analyzis, message, db_filenames, chat_id,
+                                                    timeout=120, chat_id=chat_id)
         except Exception as e:
-            # Если ошибка при анализе
-            analysis_result = f"❌ Ошибка при анализе: {str(e)}"
+            # Если ошибка при анализе, векторизация и генерация по неполным данным не запускаются
+            analysis_result = f"❌ Ошибка при анализе: {e!r}"
+            pipeline_failed = True
 
     else:
-        analysis_result = "Список файлов не был изменен, повторный анализ на релевантность не требуется"
+        analysis_result = "Список файлов и тема не были изменены, повторный анализ на релевантность не требуется"
 
     if client_id:
         final_message = models.Message(
@@ -405,21 +514,20 @@ async def create_message(
             }
         }, client_id)
 
-    if not same_lists_flag:
-        try:
+    if pipeline_failed:
+        # Следующие шаги зависят от результата упавшего
+        await manager.broadcast({"type": "chats_updated"})
+        return user_message
 
-            with ThreadPoolExecutor() as executor:
-                # Запускаем анализ в отдельном потоке
-                analysis_future = executor.submit(
-                    initial_vectorizing
-                )
-                
-                # Ждем завершения (блокируем, но в отдельном потоке)
-                analysis_result = analysis_future.result(timeout=120)
-                
+    if need_analysis:
+        try:
+            # Запускаем в общем пуле потоков
+            analysis_result = await run_in_pipeline(initial_vectorizing, chat_id, timeout=120, chat_id=chat_id)
+            clear_pipeline_incomplete(chat_id)
         except Exception as e:
-            # Если ошибка при анализе
-            analysis_result = f"❌ Ошибка при векторизации: {str(e)}"
+            # Если ошибка при векторизации, генерация по неполному индексу не запускается
+            analysis_result = f"❌ Ошибка при векторизации: {e!r}"
+            pipeline_failed = True
 
     else:
         analysis_result = "Повторная векторизация не требуется"
@@ -447,19 +555,16 @@ async def create_message(
             }
         }, client_id)
 
-    try:
+    if pipeline_failed:
+        # Следующие шаги зависят от результата упавшего
+        await manager.broadcast({"type": "chats_updated"})
+        return user_message
 
-        with ThreadPoolExecutor() as executor:
-            # Запускаем анализ в отдельном потоке
-            analysis_future = executor.submit(
-                initital_generating,
-                message,
-                mode
-            )
-            
-            # Ждем завершения (блокируем, но в отдельном потоке)
-            analysis_result = analysis_future.result(timeout=180) 
-            
+    stream_id = uuid.uuid4().hex
+    try:
+        # Запускаем в общем пуле потоков, текст обзора приходит клиенту по мере генерации
+        analysis_result = await run_streaming(initital_generating, message, mode, chat_id, client_id=client_id,
+                                              chat_id=chat_id, stream_id=stream_id, timeout=180)
     except Exception as e:
         # Если ошибка при анализе
         analysis_result = f"❌ Ошибка при генерации обзора: {str(e)}"
@@ -483,7 +588,8 @@ async def create_message(
                 "content": final_message.content,
                 "role": final_message.role,
                 "created_at": final_message.created_at.isoformat()
-            }
+            },
+            "stream_id": stream_id  # заменяет черновик, собранный из delta
         }, client_id)
 
         
@@ -492,6 +598,14 @@ async def create_message(
     
     return user_message
 
+@app.get("/api/llm/stats")
+def get_llm_stats():
+    """Статистика запросов к LLM: повторы, ожидание ограничителя частоты, кэш ответов"""
+    return {
+        "client": llm_client.get_stats(),
+        "cache": response_cache.get_stats()
+    }
+
 @app.delete("/api/chats/{chat_id}")
 def delete_chat(chat_id: int, db: Session = Depends(get_db)):
     """Удалить чат и все связанные данные"""
@@ -504,6 +618,9 @@ def delete_chat(chat_id: int, db: Session = Depends(get_db)):
         if os.path.exists(file.file_path):
             os.remove(file.file_path)
     
+    # Удаляем векторную коллекцию и промежуточные файлы чата
+    delete_chat_data(chat_id)
+    
     # Удаляем чат из БД (каскадное удаление сработает)
     db.delete(chat)
     db.commit()
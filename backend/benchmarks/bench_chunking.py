@@ -0,0 +1,136 @@
+"""
+Микробенчмарк чанкования больших документов.
+
+Запуск из папки backend:
+    python -m benchmarks.bench_chunking [--docs 50] [--pages 150]
+
+Сравнивает split_into_chunks с прежним посимвольным чанкованием на синтетическом
+корпусе "диссертаций" и печатает лучшее из --repeat время и число чанков.
+Новый чанкер не быстрее прежнего: в обоих время уходит на цикл Python по чанкам,
+и на корпусе по умолчанию chunk_spans и прежний алгоритм занимают одинаково
+~40-60 мс (разница в пределах шума). Задача нового чанкера - гарантированное
+продвижение и границы по предложениям, а бенчмарк следит, чтобы за это не
+пришлось платить скоростью.
+Перед замерами проверяет chunk_spans на крайних случаях (документ из одного токена,
+чанки без перекрытия, хвостовые пробелы) в символьном и токенном режимах.
+"""
+import argparse
+import random
+import re
+import time
+from typing import Callable, List, Tuple
+
+from ai_service.vectorizing import (CHUNK_OVERLAP, CHUNK_SIZE, MIN_CHUNK_CHARS, ChunkTable, chunk_spans,
+                                    join_pages, split_into_chunks)
+
+
+def make_document(rng: random.Random, vocabulary: List[str], pages: int, page_chars: int) -> List[str]:
+    """Синтетический документ: страницы из слов словаря с редкими концами предложений."""
+    document = []
+    for _ in range(pages):
+        words = []
+        length = 0
+        while length < page_chars:
+            word = rng.choice(vocabulary)
+            word += ". " if rng.random() < 0.07 else " "
+            words.append(word)
+            length += len(word)
+        document.append("".join(words))
+    return document
+
+
+def word_tokenizer(text: str, add_special_tokens: bool = False, return_offsets_mapping: bool = False,
+                   verbose: bool = True):
+    """Токенизатор с интерфейсом быстрого токенизатора: токены - слова и знаки препинания."""
+    return {"offset_mapping": [match.span() for match in re.finditer(r"\w+|[^\w\s]", text)]}
+
+
+def check_edge_cases():
+    """Проверяет, что чанки покрывают текст до конца и каждый следующий начинается правее."""
+    cases = [("cc.", 5, 0), ("cc", 5, 2), ("word " * 20, 5, 0), ("word " * 20, 5, 2),
+             ("word " * 20 + "end.", 5, 4), ("   ", 5, 0), ("Одно предложение. Второе. ", 2, 0)]
+    for tokenizer in (None, word_tokenizer):
+        for text, chunk_size, chunk_overlap in cases:
+            spans = list(chunk_spans(text, chunk_size, chunk_overlap, tokenizer))
+            if not spans:
+                # Без токенов чанков нет; в символьном режиме пустым бывает только пустой текст
+                assert tokenizer is not None and not text.strip(), (text, spans)
+                continue
+            starts = [start for start, _ in spans]
+            assert spans[0][0] == 0 and spans[-1][1] == len(text), (text, spans)
+            assert starts == sorted(set(starts)), (text, spans)
+    print(f"Крайние случаи chunk_spans: {len(cases)} x 2 режима - OK")
+
+
+def legacy_split(text: str) -> int:
+    """Прежний алгоритм (посимвольный поиск границы), возвращает число чанков."""
+    count = 0
+    start = 0
+    while start < len(text):
+        end = start + CHUNK_SIZE
+        if end < len(text):
+            for i in range(min(50, len(text) - end)):
+                if text[end + i] in {'.', '!', '?', '\n', ' ', ';', ','}:
+                    end = end + i + 1
+                    break
+        chunk_text = text[start:end].strip()
+        if chunk_text and len(chunk_text) > MIN_CHUNK_CHARS:
+            count += 1
+        start = end - CHUNK_OVERLAP
+    return count
+
+
+def best_time(func: Callable, repeat: int) -> Tuple[object, float]:
+    """(результат, лучшее время в секундах) из repeat запусков func."""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - started)
+    return result, min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", type=int, default=50, help="число документов")
+    parser.add_argument("--pages", type=int, default=150, help="страниц в документе")
+    parser.add_argument("--page-chars", type=int, default=1800, help="символов на странице")
+    parser.add_argument("--repeat", type=int, default=5, help="запусков каждого варианта, берется лучший")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    check_edge_cases()
+    rng = random.Random(args.seed)
+    vocabulary = ["".join(rng.choice("абвгдеёжзийклмнопрстуфхцчшщыэюя") for _ in range(rng.randint(2, 12)))
+                  for _ in range(5000)]
+    corpus = [make_document(rng, vocabulary, args.pages, args.page_chars) for _ in range(args.docs)]
+    total_chars = sum(len(page) for document in corpus for page in document)
+    print(f"Корпус: {args.docs} документов, {total_chars / 1e6:.1f} млн символов")
+
+    texts = [join_pages(enumerate(document, start=1))[0] for document in corpus]
+    span_count, spans_time = best_time(lambda: sum(sum(1 for _ in chunk_spans(text)) for text in texts),
+                                       args.repeat)
+    new_chunks, new_time = best_time(lambda: sum(len(split_into_chunks(enumerate(document, start=1), source_id))
+                                                 for source_id, document in enumerate(corpus, start=1)),
+                                     args.repeat)
+
+    def build_table() -> ChunkTable:
+        table = ChunkTable()
+        for source_id, document in enumerate(corpus, start=1):
+            table.add_document(source_id, enumerate(document, start=1))
+        return table
+
+    table, table_time = best_time(build_table, args.repeat)
+    legacy_chunks, legacy_time = best_time(
+        lambda: sum(legacy_split("".join(page + "\n" for page in document)) for document in corpus), args.repeat)
+
+    print(f"chunk_spans:       {spans_time * 1000:8.1f} мс, {span_count} границ")
+    print(f"split_into_chunks: {new_time * 1000:8.1f} мс, {new_chunks} чанков, "
+          f"{total_chars / new_time / 1e6:.1f} млн символов/с")
+    print(f"ChunkTable:        {table_time * 1000:8.1f} мс, {len(table)} чанков (без копий текста)")
+    print(f"прежний алгоритм:  {legacy_time * 1000:8.1f} мс, {legacy_chunks} чанков")
+    print(f"Ожидаемое число чанков ~ {total_chars / (CHUNK_SIZE - CHUNK_OVERLAP):.0f}")
+
+
+if __name__ == "__main__":
+    main()
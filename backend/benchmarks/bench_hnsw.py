@@ -0,0 +1,68 @@
+"""
+Подбор параметров HNSW-индекса ChromaDB под размеры коллекций наших чатов.
+
+Запуск из папки backend:
+    python -m benchmarks.bench_hnsw [--sizes 5000 20000] [--m 8 16 32]
+                                    [--construction-ef 100 200] [--search-ef 10 50 100 200]
+
+Для каждого размера коллекции и каждой тройки (M, construction_ef, search_ef) строит
+отдельную коллекцию во временной папке на синтетических эмбеддингах: search_ef,
+измененный у уже загруженного индекса, ChromaDB не применяет, поэтому каждое
+значение проверяется на своей коллекции. Запросы - отложенные векторы того же
+распределения, которых нет в коллекции; мелкие кластеры (--cluster-size) делают
+данные близкими к равномерным, и recall заметно зависит от параметров. Печатает время построения, задержку
+пакетного запроса из 6 поисков (p50/p99) и recall@k относительно точного поиска.
+Найденные значения задаются в ai_service.vector_store (HNSW_*).
+"""
+import argparse
+import tempfile
+from itertools import product
+from pathlib import Path
+
+import chromadb
+import numpy as np
+
+from ai_service.vector_store import HNSW_CONSTRUCTION_EF, HNSW_M, HNSW_SEARCH_EF, ChromaVectorStore
+from benchmarks.bench_vector_store import build, run_queries
+from benchmarks.vector_data import exact_top_k, make_embeddings, percentile_ms, recall_at_k, split_held_out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[5000, 20000], help="числа чанков")
+    parser.add_argument("--dim", type=int, default=384, help="размерность эмбеддингов (MiniLM - 384)")
+    parser.add_argument("--m", type=int, nargs="+", default=[8, HNSW_M, 32])
+    parser.add_argument("--construction-ef", type=int, nargs="+", default=[HNSW_CONSTRUCTION_EF, 200])
+    parser.add_argument("--search-ef", type=int, nargs="+", default=[10, 50, HNSW_SEARCH_EF, 200])
+    parser.add_argument("--cluster-size", type=int, default=5,
+                        help="векторов на центр: чем меньше, тем равномернее данные и труднее поиск")
+    parser.add_argument("--queries", type=int, default=120)
+    parser.add_argument("--k", type=int, default=10, help="top-k (generate_*_review берут меньше, но шире - строже)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    print(f"{'чанков':>8} {'M':>4} {'constr_ef':>10} {'search_ef':>10} {'построение, мс':>15} "
+          f"{'p50, мс':>9} {'p99, мс':>9} {'recall@k':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        client = chromadb.PersistentClient(path=str(Path(tmp) / "chroma"))
+        for size in args.sizes:
+            embeddings = make_embeddings(size + args.queries, args.dim, clusters=max(1, size // args.cluster_size),
+                                         rng=rng)
+            vectors, queries = split_held_out(embeddings, args.queries)
+            expected = exact_top_k(vectors, queries, args.k)
+
+            for m, construction_ef, search_ef in product(args.m, args.construction_ef, args.search_ef):
+                name = f"bench_{size}_{m}_{construction_ef}_{search_ef}"
+                store = ChromaVectorStore.create(name, client=client, m=m, construction_ef=construction_ef,
+                                                 search_ef=search_ef)
+                build_time = build(store, vectors)
+                found, timings = run_queries(store, queries, args.k)
+                print(f"{size:>8} {m:>4} {construction_ef:>10} {search_ef:>10} {build_time * 1000:>15.1f} "
+                      f"{percentile_ms(timings, 50):>9.2f} {percentile_ms(timings, 99):>9.2f} "
+                      f"{recall_at_k(found, expected):>9.3f}")
+                store.drop()
+
+
+if __name__ == "__main__":
+    main()
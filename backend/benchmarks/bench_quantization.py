@@ -0,0 +1,88 @@
+"""
+Потери качества и выигрыш в памяти и на диске от компактного хранения векторов NumPy-индекса.
+
+Запуск из папки backend:
+    python -m benchmarks.bench_quantization [--size 5000] [--queries 120] [--k 4]
+
+Для float32, float16 и int8 строит и сохраняет индекс на синтетических эмбеддингах
+и печатает объем векторов в памяти, все файлы индекса чата на диске (матрица, векторы
+для пересчета и .json с текстами и метаданными чанков), задержку пакета из 6 запросов
+и recall@k относительно точного поиска в float32 - без пересчета кандидатов и с пересчетом
+по float16-копии векторов (RESCORE_FACTOR, только для int8).
+int8 уменьшает в 4 раза только память процесса: на диске рядом с int8-матрицей лежит
+float16-копия для пересчета (~3 байта на измерение), поэтому файлы int8-индекса больше,
+чем у float16, и лишь немного меньше, чем у float32.
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from ai_service import vector_store
+from ai_service.vector_store import PRECISIONS, NumpyVectorStore
+from benchmarks.vector_data import exact_top_k, make_embeddings, make_queries, percentile_ms, recall_at_k
+
+QUERIES_PER_REVIEW = 6
+
+
+def run(store: NumpyVectorStore, queries: np.ndarray, k: int):
+    found, timings = [], []
+    for i in range(0, len(queries), QUERIES_PER_REVIEW):
+        started = time.perf_counter()
+        results = store.query(queries[i:i + QUERIES_PER_REVIEW], k)
+        timings.append(time.perf_counter() - started)
+        found.extend([int(match["id"]) for match in matches] for matches in results)
+    return found, timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=5000, help="число чанков")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=120)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--rescore-factor", type=int, default=vector_store.RESCORE_FACTOR)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    vectors = make_embeddings(args.size, args.dim, clusters=max(1, args.size // 50), rng=rng)
+    queries = make_queries(vectors, args.queries, rng)
+    expected = exact_top_k(vectors, queries, args.k)
+    ids = [str(i) for i in range(args.size)]
+    # Тексты размером с реальный чанк, чтобы .json индекса был сопоставим с рабочим
+    documents = [f"чанк {i} " + "текст " * 110 for i in range(args.size)]
+    metadatas = [{"doc_hash": "bench", "source_id": 1, "approx_page": 1, "chunk_num": i} for i in range(args.size)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"{args.size} чанков, размерность {args.dim}, k={args.k}, "
+              f"пересчет {args.rescore_factor}*k кандидатов")
+        print(f"{'точность':>9} {'память, КБ':>11} {'сжатие':>7} {'матрица, КБ':>12} {'пересчет, КБ':>13} "
+              f"{'json, КБ':>9} {'диск, КБ':>9} {'p50, мс':>9} {'p99, мс':>9} {'recall':>8} {'recall+пересчет f16':>20}")
+        baseline_bytes = None
+        for precision in PRECISIONS:
+            store = NumpyVectorStore(Path(tmp) / f"{precision}.npy", precision)
+            store.upsert(ids, vectors, documents, metadatas)
+            store.save()
+            # Поиск - как на сервере: по загруженному индексу с отображенным в память файлом пересчета
+            store = NumpyVectorStore.load(store.path)
+            baseline_bytes = baseline_bytes or store.nbytes()
+            disk = store.disk_bytes()
+
+            vector_store.RESCORE_FACTOR = 1
+            plain, timings = run(store, queries, args.k)
+            vector_store.RESCORE_FACTOR = args.rescore_factor
+            rescored, rescored_timings = run(store, queries, args.k)
+            # Пересчет выполняется только для int8, для остальных задержка одинакова
+            shown = rescored_timings if precision == "int8" else timings
+
+            print(f"{precision:>9} {store.nbytes() / 1024:>11.0f} {baseline_bytes / store.nbytes():>6.1f}x "
+                  f"{disk['vectors'] / 1024:>12.0f} {disk['rescore'] / 1024:>13.0f} {disk['meta'] / 1024:>9.0f} "
+                  f"{sum(disk.values()) / 1024:>9.0f} {percentile_ms(shown, 50):>9.2f} {percentile_ms(shown, 99):>9.2f} "
+                  f"{recall_at_k(plain, expected):>8.3f} {recall_at_k(rescored, expected):>20.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Сравнение бэкендов векторного индекса на коллекциях размера типичного чата.
+
+Запуск из папки backend:
+    python -m benchmarks.bench_vector_store [--sizes 500 2000 10000] [--queries 60]
+
+Для каждого размера строит NumpyVectorStore и ChromaVectorStore (во временной папке)
+на синтетических эмбеддингах и печатает время построения, задержку пакетного запроса
+из 6 поисков (p50/p99) и recall@k относительно точного поиска.
+"""
+import argparse
+import contextlib
+import io
+import tempfile
+import time
+from pathlib import Path
+
+import chromadb
+import numpy as np
+
+from ai_service.vector_store import ChromaVectorStore, NumpyVectorStore
+from benchmarks.vector_data import exact_top_k, make_embeddings, make_queries, percentile_ms, recall_at_k
+
+QUERIES_PER_REVIEW = 6  # столько запросов делает один обзор (SEARCH_QUERIES)
+
+
+def build(store, vectors: np.ndarray) -> float:
+    ids = [f"doc_{i}" for i in range(len(vectors))]
+    metadatas = [{"doc_hash": f"doc{i // 50}", "source_id": i // 50, "approx_page": 1, "chunk_num": i % 50}
+                 for i in range(len(vectors))]
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):  # без построчного лога батчей
+        store.upsert(ids, vectors, [f"чанк {i}" for i in range(len(vectors))], metadatas)
+        store.save()
+    return time.perf_counter() - started
+
+
+def run_queries(store, queries: np.ndarray, k: int):
+    """Выполняет запросы пачками по QUERIES_PER_REVIEW, возвращает (найденные индексы, времена пачек)."""
+    found, timings = [], []
+    for i in range(0, len(queries), QUERIES_PER_REVIEW):
+        started = time.perf_counter()
+        results = store.query(queries[i:i + QUERIES_PER_REVIEW], k)
+        timings.append(time.perf_counter() - started)
+        found.extend([int(match["id"].split("_")[1]) for match in matches] for matches in results)
+    return found, timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[500, 2000, 10000], help="числа чанков")
+    parser.add_argument("--dim", type=int, default=384, help="размерность эмбеддингов (MiniLM - 384)")
+    parser.add_argument("--queries", type=int, default=60)
+    parser.add_argument("--k", type=int, default=4, help="top-k, как в generate_*_review")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    print(f"{'чанков':>8} {'бэкенд':>8} {'построение, мс':>15} {'p50, мс':>9} {'p99, мс':>9} {'recall@k':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            vectors = make_embeddings(size, args.dim, clusters=max(1, size // 50), rng=rng)
+            queries = make_queries(vectors, args.queries, rng)
+            expected = exact_top_k(vectors, queries, args.k)
+
+            client = chromadb.PersistentClient(path=str(Path(tmp) / "chroma"))
+            stores = [
+                ("numpy", NumpyVectorStore(Path(tmp) / f"bench_{size}.npy")),
+                ("chroma", ChromaVectorStore.create(f"bench_{size}", client=client))
+            ]
+
+            for name, store in stores:
+                build_time = build(store, vectors)
+                found, timings = run_queries(store, queries, args.k)
+                print(f"{size:>8} {name:>8} {build_time * 1000:>15.1f} {percentile_ms(timings, 50):>9.2f} "
+                      f"{percentile_ms(timings, 99):>9.2f} {recall_at_k(found, expected):>9.3f}")
+
+
+if __name__ == "__main__":
+    main()
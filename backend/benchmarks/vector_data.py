@@ -0,0 +1,51 @@
+"""
+Общие утилиты бенчмарков векторного поиска: синтетические эмбеддинги,
+точный top-k и метрики.
+"""
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+
+def make_embeddings(n: int, dim: int, clusters: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Нормированные эмбеддинги, сгруппированные вокруг clusters центров -
+    как чанки нескольких статей на близкие темы.
+    """
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, clusters, size=n)
+    vectors = centers[labels] + 0.8 * rng.standard_normal((n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def make_queries(vectors: np.ndarray, count: int, rng: np.random.Generator) -> np.ndarray:
+    """Запросы - зашумленные копии случайных векторов корпуса."""
+    picked = vectors[rng.integers(0, len(vectors), size=count)]
+    queries = picked + 0.5 * rng.standard_normal(picked.shape).astype(np.float32) / np.sqrt(vectors.shape[1])
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def split_held_out(vectors: np.ndarray, count: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    (корпус, запросы): последние count векторов не индексируются и служат запросами -
+    из того же распределения, но без почти-копий в корпусе, так что recall HNSW
+    зависит от параметров поиска.
+    """
+    return vectors[:-count], vectors[-count:]
+
+
+def exact_top_k(vectors: np.ndarray, queries: np.ndarray, k: int) -> List[List[int]]:
+    """Эталонный top-k полным перебором."""
+    scores = queries @ vectors.T
+    return np.argsort(-scores, axis=1)[:, :k].tolist()
+
+
+def recall_at_k(found: Sequence[Sequence[int]], expected: Sequence[Sequence[int]]) -> float:
+    """Средняя доля эталонных соседей, попавших в найденные."""
+    hits = sum(len(set(f) & set(e)) for f, e in zip(found, expected))
+    total = sum(len(e) for e in expected)
+    return hits / total if total else 1.0
+
+
+def percentile_ms(timings: Sequence[float], q: float) -> float:
+    return float(np.percentile(np.asarray(timings) * 1000, q))
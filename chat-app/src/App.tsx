@@ -9,7 +9,7 @@ import { MessageSquare, Menu, X } from 'lucide-react';
 import { websocketService } from './services/websocket';
 
 function App() {
-  const { addMessage, chats, setChats, currentChat, setCurrentChat, setLoading, setError } = useChatStore();
+  const { addMessage, appendStreamDelta, finishStream, chats, setChats, currentChat, setCurrentChat, setLoading, setError } = useChatStore();
   const [isChatListVisible, setIsChatListVisible] = React.useState(true);
   const [isFileListVisible, setIsFileListVisible] = React.useState(true);
 
@@ -30,10 +30,19 @@ function App() {
         console.log('🔌 WebSocket отключен');
       },
       
-      onNewMessage: (message: any) => {
+      onNewMessage: (message: any, streamId?: string) => {
         console.log('📨 Получено сообщение через WebSocket:', message);
-        // Добавляем сообщение в хранилище
-        addMessage(message);
+        // Добавляем сообщение в хранилище (итоговое сообщение потока заменяет черновик)
+        if (streamId) {
+          finishStream(streamId, message);
+        } else {
+          addMessage(message);
+        }
+      },
+      
+      onDelta: (data: { stream_id: string; chat_id: number; delta: string }) => {
+        // Дописываем фрагмент генерируемого ответа в черновик
+        appendStreamDelta(data.stream_id, data.chat_id, data.delta);
       },
       
       onChatsUpdated: () => {
@@ -2,13 +2,14 @@ import type { Message } from '../types';
 
 // Типы для WebSocket сообщений
 export interface WebSocketMessage {
-  type: 'message' | 'chats_updated' | 'processing_started' | 'error';
+  type: 'message' | 'delta' | 'chats_updated' | 'processing_started' | 'error';
   [key: string]: any;
 }
 
 // Колбэки для обработки WebSocket событий
 export interface WebSocketCallbacks {
-  onNewMessage?: (message: Message) => void;
+  onNewMessage?: (message: Message, streamId?: string) => void;
+  onDelta?: (data: { stream_id: string; chat_id: number; delta: string }) => void;
   onChatsUpdated?: () => void;
   onProcessingStarted?: (data: { chat_id: number }) => void;
   onError?: (error: string) => void;
@@ -120,7 +121,9 @@ class WebSocketManager {
   }
 
   private handleIncomingMessage(data: WebSocketMessage): void {
-    console.log('📨 Получено WebSocket сообщение:', data);
+    if (data.type !== 'delta') {
+      console.log('📨 Получено WebSocket сообщение:', data);
+    }
     
     switch (data.type) {
       case 'message':
@@ -134,9 +137,15 @@ class WebSocketManager {
             created_at: data.message.created_at,
             mode: data.message.mode
           };
-          this.callbacks.onNewMessage?.(message);
+          // stream_id есть у сообщений, текст которых перед этим приходил по частям (delta)
+          this.callbacks.onNewMessage?.(message, data.stream_id);
         }
         break;
+
+      case 'delta':
+        // Очередной фрагмент генерируемого ответа
+        this.callbacks.onDelta?.({ stream_id: data.stream_id, chat_id: data.chat_id, delta: data.delta });
+        break;
         
       case 'chats_updated':
         // Обновление списка чатов
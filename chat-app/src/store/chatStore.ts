@@ -13,6 +13,8 @@ interface ChatStore {
   setChats: (chats: Chat[]) => void;
   setCurrentChat: (chat: ChatDetail | null) => void;
   addMessage: (message: Message) => void;
+  appendStreamDelta: (streamId: string, chatId: number, delta: string) => void;
+  finishStream: (streamId: string, message: Message) => void;
   addFileToCurrentChat: (file: ChatFile) => void;
   removeFileFromCurrentChat: (fileName: string) => void;
   clearCurrentChatFiles: () => void;
@@ -47,6 +49,54 @@ export const useChatStore = create<ChatStore>((set: (arg0: { (state: any): { cur
         : null,
     })),
   
+  // Черновик ответа, который собирается из потока delta до прихода итогового сообщения
+  // Фрагменты потока другого чата (пользователь переключился во время генерации) пропускаем:
+  // итоговое сообщение сохранено на сервере и придет при открытии того чата
+  appendStreamDelta: (streamId: string, chatId: number, delta: string) =>
+    set((state) => {
+      if (!state.currentChat || String(state.currentChat.id) !== String(chatId)) {
+        return { currentChat: state.currentChat };
+      }
+      const draftId = `stream-${streamId}`;
+      const messages = state.currentChat.messages;
+      const hasDraft = messages.some((m: Message) => m.id === draftId);
+      return {
+        currentChat: {
+          ...state.currentChat,
+          messages: hasDraft
+            ? messages.map((m: Message) => (m.id === draftId ? { ...m, content: m.content + delta } : m))
+            : [
+                ...messages,
+                {
+                  id: draftId,
+                  chat_id: String(chatId),
+                  content: delta,
+                  role: 'assistant',
+                  created_at: new Date().toISOString(),
+                },
+              ],
+        },
+      };
+    }),
+
+  // Итоговое сообщение заменяет черновик (или добавляется, если потока не было)
+  finishStream: (streamId: string, message: any) =>
+    set((state) => {
+      if (!state.currentChat || String(state.currentChat.id) !== String(message.chat_id)) {
+        return { currentChat: state.currentChat };
+      }
+      const draftId = `stream-${streamId}`;
+      const messages = state.currentChat.messages;
+      return {
+        currentChat: {
+          ...state.currentChat,
+          messages: messages.some((m: Message) => m.id === draftId)
+            ? messages.map((m: Message) => (m.id === draftId ? message : m))
+            : [...messages, message],
+        },
+      };
+    }),
+  
   addFileToCurrentChat: (file: any) =>
     set((state) => ({
       currentChat: state.currentChat